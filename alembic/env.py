@@ -12,6 +12,8 @@ sys.path = ['', '..'] + sys.path[1:]
 from resources.globals import db_url, Base
 from bot import Base
 
+from libs.partitions import is_partition_name
+
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
@@ -26,6 +28,18 @@ fileConfig(config.config_file_name)
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
 
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Партиции таблиц истории создаются по месяцам (libs/partitions.py) и не описаны в моделях -
+    autogenerate не должен генерировать для них drop_table
+    """
+    if type_ == "table" and reflected and compare_to is None and is_partition_name(name):
+        return False
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -51,6 +65,7 @@ def run_migrations_offline():
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -75,7 +90,7 @@ def run_migrations_online():
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_object=include_object
         )
 
         with context.begin_transaction():
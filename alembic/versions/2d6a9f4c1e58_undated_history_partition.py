@@ -0,0 +1,47 @@
+"""Move undated history rows out of default partitions
+
+Revision ID: 2d6a9f4c1e58
+Revises: 5b8e2d7f1a39
+Create Date: 2026-10-19 14:37:05.206118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from libs.partitions import HISTORY_TABLES, UNDATED_MONTH, add_months, partition_name, default_partition_name
+
+
+# revision identifiers, used by Alembic.
+revision = '2d6a9f4c1e58'
+down_revision = '5b8e2d7f1a39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """
+    Строки без даты b7e0f5d2c6a1 раньше клал в партицию по умолчанию, которую политика хранения не трогает.
+    Они переносятся в помесячную партицию UNDATED_MONTH. Партицию нельзя создать, пока подходящие строки
+    лежат в DEFAULT, поэтому она создаётся отдельной таблицей и присоединяется после переноса
+    """
+    connection = op.get_bind()
+    start, end = UNDATED_MONTH.isoformat(), add_months(UNDATED_MONTH, 1).isoformat()
+    for table in HISTORY_TABLES:
+        name, default = partition_name(table, UNDATED_MONTH), default_partition_name(table)
+        has_rows = connection.execute(sa.text(
+            "SELECT EXISTS (SELECT 1 FROM {} WHERE date >= :start AND date < :end)".format(default)),
+            {"start": start, "end": end}).scalar()
+        if not has_rows:
+            continue
+        op.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(name, table))
+        op.execute(
+            "WITH moved AS (DELETE FROM {1} WHERE date >= '{2}' AND date < '{3}' RETURNING *) "
+            "INSERT INTO {0} SELECT * FROM moved".format(name, default, start, end)
+        )
+        op.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}')".format(
+            table, name, start, end))
+
+
+def downgrade():
+    # Строки остаются в таблице истории, в отдельной партиции они ничему не мешают
+    pass
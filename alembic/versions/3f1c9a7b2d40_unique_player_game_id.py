@@ -0,0 +1,72 @@
+"""Unique player game_id
+
+Revision ID: 3f1c9a7b2d40
+Revises: c5c40d77d162
+Create Date: 2026-10-18 12:04:11.318024
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7b2d40'
+down_revision = 'c5c40d77d162'
+branch_labels = None
+depends_on = None
+
+
+HISTORY_TABLES = ("exp_changes", "lvl_changes", "rank_changes", "faction_changes", "username_changes",
+                  "location_changes")
+ASSOCIATION_TABLES = ("suitable_ships", "crashed_ships", "subscribed_ships")
+
+
+def merge_duplicate_players():
+    """
+    Старый get_create_player мог создать несколько игроков с одним game_id.
+    Остаётся игрок с наименьшим id, ссылки дубликатов переносятся на него, дубликаты удаляются
+    """
+    op.execute(
+        "CREATE TEMPORARY TABLE player_duplicates AS "
+        "SELECT players.id AS duplicate_id, keepers.id AS keeper_id FROM players "
+        "JOIN (SELECT game_id, min(id) AS id FROM players WHERE game_id IS NOT NULL "
+        "GROUP BY game_id HAVING count(*) > 1) AS keepers "
+        "ON players.game_id = keepers.game_id AND players.id != keepers.id"
+    )
+    for table in HISTORY_TABLES:
+        op.execute(
+            "UPDATE {0} SET player_id = player_duplicates.keeper_id FROM player_duplicates "
+            "WHERE {0}.player_id = player_duplicates.duplicate_id".format(table)
+        )
+    for table in ASSOCIATION_TABLES:
+        # Связь с кораблём, которая уже есть у оставляемого игрока, не дублируется
+        op.execute(
+            "DELETE FROM {0} USING player_duplicates WHERE {0}.player_id = player_duplicates.duplicate_id AND "
+            "EXISTS (SELECT 1 FROM {0} AS kept WHERE kept.player_id = player_duplicates.keeper_id "
+            "AND kept.ship_id = {0}.ship_id)".format(table)
+        )
+        op.execute(
+            "UPDATE {0} SET player_id = player_duplicates.keeper_id FROM player_duplicates "
+            "WHERE {0}.player_id = player_duplicates.duplicate_id".format(table)
+        )
+    op.execute(
+        "UPDATE players SET telegram_id = duplicates.telegram_id FROM player_duplicates "
+        "JOIN players AS duplicates ON duplicates.id = player_duplicates.duplicate_id "
+        "WHERE players.id = player_duplicates.keeper_id AND players.telegram_id IS NULL "
+        "AND duplicates.telegram_id IS NOT NULL"
+    )
+    op.execute("DELETE FROM players USING player_duplicates WHERE players.id = player_duplicates.duplicate_id")
+    op.execute("DROP TABLE player_duplicates")
+
+
+def upgrade():
+    merge_duplicate_players()
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.create_unique_constraint('players_game_id_key', 'players', ['game_id'])
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_constraint('players_game_id_key', 'players', type_='unique')
+    # ### end Alembic commands ###
@@ -0,0 +1,33 @@
+"""Name search indexes
+
+Revision ID: 4a6c8e1f0b27
+Revises: b7e0f5d2c6a1
+Create Date: 2026-10-18 18:47:05.640218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a6c8e1f0b27'
+down_revision = 'b7e0f5d2c6a1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # Поиск по началу имени: lower(x) LIKE 'abc%'
+    op.execute("CREATE INDEX ix_players_username_lower ON players (lower(username) text_pattern_ops)")
+    op.execute("CREATE INDEX ix_ships_code_lower ON ships (lower(code) text_pattern_ops)")
+    # Поиск с опечатками: similarity / % по триграммам
+    op.execute("CREATE INDEX ix_players_username_trgm ON players USING gin (lower(username) gin_trgm_ops)")
+    op.execute("CREATE INDEX ix_ships_code_trgm ON ships USING gin (lower(code) gin_trgm_ops)")
+
+
+def downgrade():
+    op.drop_index("ix_ships_code_trgm", table_name="ships")
+    op.drop_index("ix_players_username_trgm", table_name="players")
+    op.drop_index("ix_ships_code_lower", table_name="ships")
+    op.drop_index("ix_players_username_lower", table_name="players")
@@ -0,0 +1,92 @@
+"""Partitioned history tables
+
+Revision ID: b7e0f5d2c6a1
+Revises: 8d2e41c7a9b3
+Create Date: 2026-10-18 16:02:54.117390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from libs.partitions import HISTORY_TABLES, UNDATED_MONTH, month_start, add_months, create_partition_sql, \
+    create_default_partition_sql
+
+import datetime
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e0f5d2c6a1'
+down_revision = '8d2e41c7a9b3'
+branch_labels = None
+depends_on = None
+
+
+VALUE_COLUMNS = {
+    "exp_changes": ("new_value", "INTEGER"),
+    "lvl_changes": ("new_value", "INTEGER"),
+    "rank_changes": ("new_value", "INTEGER"),
+    "faction_changes": ("new_value", "VARCHAR"),
+    "username_changes": ("new_value", "VARCHAR"),
+    "location_changes": ("new_location_id", "INTEGER REFERENCES locations (id)"),
+}
+MONTHS_AHEAD = 2
+
+
+def upgrade():
+    connection = op.get_bind()
+    current_month = month_start(datetime.date.today())
+    for table in HISTORY_TABLES:
+        value_column, value_type = VALUE_COLUMNS.get(table)
+        op.execute("ALTER TABLE {0} RENAME TO {0}_old".format(table))
+        op.execute("ALTER TABLE {0}_old RENAME CONSTRAINT {0}_pkey TO {0}_old_pkey".format(table))
+        op.execute(
+            "CREATE TABLE {0} ("
+            "id INTEGER NOT NULL DEFAULT nextval('{0}_id_seq'), "
+            "player_id INTEGER REFERENCES players (id), "
+            "{1} {2}, "
+            "date TIMESTAMP NOT NULL, "
+            "PRIMARY KEY (id, date)"
+            ") PARTITION BY RANGE (date)".format(table, value_column, value_type)
+        )
+        op.execute("ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id".format(table))
+        op.create_index("ix_{}_player_id_date".format(table), table, ["player_id", "date"])
+
+        op.execute(create_default_partition_sql(table))
+        first_date = connection.execute(sa.text("SELECT min(date) FROM {}_old".format(table))).scalar()
+        month = month_start(first_date) if first_date else current_month
+        while month <= add_months(current_month, MONTHS_AHEAD):
+            op.execute(create_partition_sql(table, month))
+            month = add_months(month, 1)
+
+        # Строкам без даты ставится UNDATED_MONTH, у них своя партиция - иначе они навсегда остались бы в DEFAULT
+        if connection.execute(sa.text("SELECT EXISTS (SELECT 1 FROM {}_old WHERE date IS NULL)".format(
+                table))).scalar():
+            op.execute(create_partition_sql(table, UNDATED_MONTH))
+        op.execute(
+            "INSERT INTO {0} (id, player_id, {1}, date) "
+            "SELECT id, player_id, {1}, COALESCE(date, '{2}') FROM {0}_old".format(
+                table, value_column, UNDATED_MONTH.isoformat())
+        )
+        op.drop_table("{}_old".format(table))
+
+
+def downgrade():
+    for table in HISTORY_TABLES:
+        value_column, value_type = VALUE_COLUMNS.get(table)
+        op.execute("ALTER TABLE {0} RENAME TO {0}_partitioned".format(table))
+        op.execute("ALTER TABLE {0}_partitioned RENAME CONSTRAINT {0}_pkey TO {0}_partitioned_pkey".format(table))
+        op.drop_index("ix_{}_player_id_date".format(table), table_name="{}_partitioned".format(table))
+        op.execute(
+            "CREATE TABLE {0} ("
+            "id INTEGER NOT NULL DEFAULT nextval('{0}_id_seq') PRIMARY KEY, "
+            "player_id INTEGER REFERENCES players (id), "
+            "{1} {2}, "
+            "date TIMESTAMP"
+            ")".format(table, value_column, value_type)
+        )
+        op.execute("ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id".format(table))
+        op.execute(
+            "INSERT INTO {0} (id, player_id, {1}, date) "
+            "SELECT id, player_id, {1}, date FROM {0}_partitioned".format(table, value_column)
+        )
+        op.execute("DROP TABLE {}_partitioned CASCADE".format(table))
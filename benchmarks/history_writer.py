@@ -0,0 +1,72 @@
+"""
+Запись истории изменений игроков за тик: PlayerHistoryWriter (COPY и многострочный INSERT) против ORM
+(session.add на каждое изменение). Пишет в базу из config.py, каждый способ - в своей транзакции, которая
+откатывается.
+
+    python benchmarks/history_writer.py [--players 10000] [--repeat 3]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import sessionmaker
+
+from resources.globals import engine
+
+from libs.models.Player import Player, PlayerHistoryWriter
+
+import argparse
+import time
+
+
+def create_players(session, count: int):
+    players = list(map(lambda i: Player(game_id="benchmark_{}".format(i), username="benchmark_{}".format(i),
+                                        lvl=1, exp=0, rank=i + 1, faction="fmc"), range(count)))
+    session.add_all(players)
+    session.flush()
+    return players
+
+
+def apply_changes(players, session, history: PlayerHistoryWriter = None):
+    # Тик, в котором у каждого игрока изменились опыт, уровень и место в топе
+    for player in players:
+        player.update_exp(player.exp + 100, session, history)
+        player.update_lvl(player.lvl + 1, session, history)
+        player.update_rank(player.rank + 1, session, history)
+
+
+def run(mode: str, players_count: int) -> float:
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = sessionmaker(bind=connection, autoflush=False)()
+    try:
+        players = create_players(session, players_count)
+        started = time.perf_counter()
+        if mode == "orm":
+            apply_changes(players, session)
+        else:
+            history = PlayerHistoryWriter(use_copy=mode == "copy")
+            apply_changes(players, session, history)
+            history.write(session)
+        session.flush()
+        return time.perf_counter() - started
+    finally:
+        session.close()
+        transaction.rollback()
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    print("{} players, {} history rows per tick".format(args.players, args.players * 3))
+    for mode in ("orm", "insert", "copy"):
+        best = min(run(mode, args.players) for _ in range(args.repeat))
+        print("{:>6}: {:.3f} s ({:.0f} rows/s)".format(mode, best, args.players * 3 / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Очередь сообщений AsyncBot: PriorityMessageQueue (в памяти процесса) против multiprocessing.Queue
+(сериализация и pipe), как было раньше. Производители и воркеры - потоки, как в боте.
+Измеряются пропускная способность и задержка от постановки в очередь до получения воркером.
+
+    python benchmarks/message_queue.py [--messages 100000] [--producers 4] [--workers 16]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.bot import MessageInQueue, PriorityMessageQueue, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+import argparse
+import multiprocessing
+import statistics
+import threading
+import time
+
+
+class MultiprocessingQueue:
+    """
+    multiprocessing.Queue с интерфейсом PriorityMessageQueue (приоритет не учитывается)
+    """
+
+    def __init__(self):
+        self._queue = multiprocessing.Queue()
+
+    def put(self, message: MessageInQueue, priority: int = None):
+        self._queue.put(message)
+
+    def get(self) -> MessageInQueue:
+        return self._queue.get()
+
+
+def run(message_queue, messages: int, producers: int, workers: int):
+    latencies = [[] for _ in range(workers)]
+
+    def produce(count: int):
+        for i in range(count):
+            message_queue.put(MessageInQueue(chat_id=i, text="Сообщение {}".format(i), parse_mode="HTML",
+                                             priority=PRIORITY_BULK if i % 4 else PRIORITY_INTERACTIVE,
+                                             queued=time.perf_counter()))
+
+    def work(index: int):
+        while True:
+            message = message_queue.get()
+            if message is None:
+                return
+            latencies[index].append(time.perf_counter() - message.kwargs.get("queued"))
+
+    worker_threads = list(map(lambda i: threading.Thread(target=work, args=(i, )), range(workers)))
+    producer_threads = list(map(lambda i: threading.Thread(target=produce, args=(messages // producers, )),
+                                range(producers)))
+    started = time.perf_counter()
+    for thread in worker_threads + producer_threads:
+        thread.start()
+    for thread in producer_threads:
+        thread.join()
+    for _ in worker_threads:
+        message_queue.put(None)
+    for thread in worker_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for worker_latencies in latencies for latency in worker_latencies)
+    return len(latencies) / elapsed, statistics.median(latencies) * 1000, \
+        latencies[int(len(latencies) * 0.99)] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+    for name, message_queue in (("PriorityMessageQueue", PriorityMessageQueue()),
+                                ("multiprocessing.Queue", MultiprocessingQueue())):
+        throughput, median, p99 = run(message_queue, args.messages, args.producers, args.workers)
+        print("{:>21}: {:.0f} messages/s, latency median {:.2f} ms, p99 {:.2f} ms".format(
+            name, throughput, median, p99))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Задержка поиска игрока по нику в снапшоте (libs/search.NameIndex) на 10k и 100k игроков:
+по началу ника и с опечаткой, против линейного прохода по всем именам.
+
+    python benchmarks/name_search.py [--sizes 10000 100000] [--queries 200]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.search import NameIndex, trigrams
+
+import argparse
+import random
+import string
+import time
+
+
+def make_names(count: int, rng: random.Random):
+    return list(map(lambda i: "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 12))) +
+                    str(i), range(count)))
+
+
+def make_typo(name: str, rng: random.Random) -> str:
+    position = rng.randrange(len(name))
+    return name[:position] + rng.choice(string.ascii_lowercase) + name[position + 1:]
+
+
+def linear_search(names, query: str):
+    query = query.lower()
+    found = list(filter(lambda name: name.startswith(query), names))
+    if found:
+        return found
+    query_trigrams = trigrams(query)
+    similarities = map(lambda name: (name, len(query_trigrams & trigrams(name)) /
+                                     len(query_trigrams | trigrams(name))), names)
+    return list(map(lambda item: item[0], sorted(filter(lambda item: item[1] >= NameIndex.MIN_SIMILARITY,
+                                                        similarities), key=lambda item: -item[1])))
+
+
+def measure(search, queries) -> float:
+    """
+    :return: Среднее время одного поиска, мс
+    """
+    started = time.perf_counter()
+    for query in queries:
+        search(query)
+    return (time.perf_counter() - started) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    for size in args.sizes:
+        names = make_names(size, rng)
+        started = time.perf_counter()
+        index = NameIndex(map(lambda name: (name, name), names))
+        build = time.perf_counter() - started
+        sample = rng.sample(names, args.queries)
+        prefixes = list(map(lambda name: name[:4], sample))
+        typos = list(map(lambda name: make_typo(name, rng), sample))
+        # Линейный поиск с опечаткой медленный - меньше запросов
+        slow_typos = typos[:max(1, args.queries // 20)]
+        print("{} players (index built in {:.2f} s)".format(size, build))
+        print("  prefix: index {:.3f} ms, linear {:.3f} ms".format(
+            measure(lambda query: index.search(query, limit=10), prefixes),
+            measure(lambda query: linear_search(names, query), prefixes)))
+        print("  typo:   index {:.3f} ms, linear {:.3f} ms".format(
+            measure(lambda query: index.search(query, limit=10), typos),
+            measure(lambda query: linear_search(names, query), slow_typos)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Отправка сообщений AsyncBot через пул потоков и через AsyncSendEngine (aiohttp) на локальный сервер,
+изображающий Bot API с задержкой ответа как у Telegram. Лимиты RateLimiter подняты, чтобы мерить
+сами способы отправки, а не лимиты.
+
+Каждый способ работает в своём процессе: кроме скорости, сравниваются пиковая память (RSS) и число потоков.
+
+    python benchmarks/send_engines.py [--messages 2000] [--latency 0.05]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from libs.bot import AsyncBot
+from libs.rate_limiter import RateLimiter
+
+from typing import Tuple
+
+import argparse
+import itertools
+import json
+import subprocess
+import threading
+import time
+
+TOKEN = "123456:benchmark-token-0000000000000000000"
+THREADS_SAMPLE_INTERVAL = 0.01  # seconds
+
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    """
+    sendMessage / editMessageText: ответ {"ok": true, "result": Message} через server.latency секунд
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.server.latency)
+        body = json.dumps({"ok": True, "result": {
+            "message_id": next(self.server.message_ids), "date": int(time.time()), "text": data.get("text", ""),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"}}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(latency: float) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BotAPIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.message_ids = itertools.count(1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(port: int, async_engine: bool, messages: int) -> Tuple[float, int]:
+    """
+    :return: Время отправки всех сообщений и наибольшее число потоков процесса за это время
+    """
+    # Число воркеров - как в resources/globals.py
+    bot = AsyncBot(token=TOKEN, workers=4 if async_engine else 16, async_engine=async_engine)
+    if async_engine and bot.engine is None:
+        raise RuntimeError("aiohttp is not installed")
+    bot.base_url = "http://127.0.0.1:{}/bot{}".format(port, TOKEN)
+    bot.rate_limiter = RateLimiter(10 ** 6, 10 ** 6, 10 ** 6)
+    if bot.engine is not None:
+        bot.engine.rate_limiter = bot.rate_limiter
+    bot.start()
+
+    sent = itertools.count(1)
+    done = threading.Event()
+    peak_threads = threading.active_count()
+
+    def on_sent(message):
+        if next(sent) == messages:
+            done.set()
+
+    def count_threads():
+        nonlocal peak_threads
+        while not done.is_set():
+            peak_threads = max(peak_threads, threading.active_count())
+            time.sleep(THREADS_SAMPLE_INTERVAL)
+
+    threading.Thread(target=count_threads, daemon=True).start()
+    started = time.perf_counter()
+    for i in range(messages):
+        bot.send_message(chat_id=i + 1, text="Сообщение {}".format(i), on_sent=on_sent)
+    finished = done.wait(timeout=300)
+    elapsed = time.perf_counter() - started
+    bot.stop()
+    if not finished:
+        raise RuntimeError("Not all messages were sent")
+    return elapsed, peak_threads
+
+
+def run_child(port: int, engine: str, messages: int) -> Tuple[float, int, int]:
+    """
+    Запускает способ отправки в отдельном процессе: память и потоки другого способа и сервера не учитываются
+    :return: Время, наибольшее число потоков, пиковый RSS процесса (КБ)
+    """
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", engine, str(port),
+                                str(messages)], stdout=subprocess.PIPE)
+    output = process.stdout.read()
+    process.stdout.close()
+    # ru_maxrss именно этого процесса: RUSAGE_CHILDREN - максимум по всем завершённым дочерним процессам
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if process.returncode != 0:
+        raise RuntimeError("{} engine failed".format(engine))
+    elapsed, threads = output.split()
+    return float(elapsed), int(threads), usage.ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа сервера, секунды")
+    parser.add_argument("--child", nargs=3, metavar=("ENGINE", "PORT", "MESSAGES"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        engine, port, messages = args.child
+        elapsed, threads = run(int(port), engine == "asyncio", int(messages))
+        print(elapsed, threads)
+        return
+
+    server = start_server(args.latency)
+    try:
+        for engine in ("threads", "asyncio"):
+            elapsed, threads, rss = run_child(server.server_address[1], engine, args.messages)
+            print("{:>7}: {} messages in {:.2f} s ({:.0f} messages/s), peak RSS {:.1f} MB, up to {} threads".format(
+                engine, args.messages, elapsed, args.messages / elapsed, rss / 1024, threads))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Пиковая память (RSS) разбора ответа /users: потоково (libs/json_stream.py) и целиком (json.load).
+Каждый способ запускается в отдельном процессе, чтобы пик одного не влиял на другой.
+
+    python benchmarks/users_parse_memory.py [--users 100000]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.json_stream import iter_array_items
+
+import argparse
+import json
+import resource
+import subprocess
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_users(count: int):
+    for i in range(count):
+        yield {"userId": "user{}".format(i), "userName": "player_{}".format(i), "rank": i + 1, "exp": 1000 * i,
+               "lvl": i % 60 + 1, "faction": ("fmc", "run", "gta")[i % 3], "location": "Luna"}
+
+
+def write_payload(path: str, count: int):
+    with open(path, "w") as file:
+        file.write('{"users": [')
+        for i, user in enumerate(make_users(count)):
+            file.write("{}{}".format("," if i else "", json.dumps(user)))
+        file.write("]}")
+
+
+def read_chunks(path: str):
+    with open(path) as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def parse(mode: str, path: str) -> int:
+    if mode == "stream":
+        return sum(1 for _ in iter_array_items(read_chunks(path), "users"))
+    with open(path) as file:
+        return len(json.load(file).get("users"))
+
+
+def peak_rss_kb() -> int:
+    # Linux: ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(mode: str, path: str) -> int:
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--child", mode, path])
+    return int(output.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        mode, path = args.child
+        count = parse(mode, path)
+        print(count, peak_rss_kb())
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "users.json")
+        write_payload(path, args.users)
+        print("Payload: {} users, {:.1f} MB".format(args.users, os.path.getsize(path) / 1024 / 1024))
+        for mode in ("stream", "full"):
+            print("{:>6}: peak RSS {:.1f} MB".format(mode, run_child(mode, path) / 1024))
+
+
+if __name__ == "__main__":
+    main()
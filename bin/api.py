@@ -1,19 +1,30 @@
 
-from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, text as sql_text
+from sqlalchemy.orm import joinedload
 
-from resources.globals import SessionMaker, dispatcher, factions
+from telegram.error import BadRequest
+
+from resources.globals import SessionMaker, dispatcher, factions, history_retention_months, history_archive_schema
 
 from libs.api import ExpeditionAPI
+from libs.bot import PRIORITY_BOARD
+from libs.eta import ProgressSamples
+from libs.fingerprints import PayloadFingerprints
+from libs.snapshot import WorldSnapshot, publish, get_snapshot
+from libs.partitions import ensure_partitions, apply_retention
 from libs.models.Location import Location
-from libs.models.Player import Player, provide_player
-from libs.models.Ship import Ship
+from libs.models.Player import Player, PlayerHistoryWriter, PlayerLocationChanges, provide_player
+from libs.models.Ship import Ship, DepartureIndex
 from libs.models.Guild import Guild
+from libs.models.Notification import Notification
 
 from bin.service import get_current_datetime, pretty_time_format, pretty_datetime_format_short, provide_session, \
-    make_progressbar
+    make_progressbar, chunks, nulls_last
 from bin.string_service import translate_number_to_emoji
+from bin.pagination import split_pages, make_pages_keyboard, send_pages, page_cache, PageCache
 
 import re
 import logging
@@ -22,83 +33,302 @@ import traceback
 
 
 TOPS_INTERVAL = 1  # minutes
+STREAM_USERS = True  # Разбирать /users потоково, не загружая весь JSON в память
+INGEST_BATCH_SIZE = 1000
+GUILD_STATS_WORKERS = 4
+REGISTER_SEARCH_LIMIT = 20
+
+# Отпечатки записей прошлого тика, неизменившиеся игроки и корабли не обрабатываются
+users_fingerprints = PayloadFingerprints("userId", ("rank", "userName", "exp", "lvl", "faction", "location"))
+ships_fingerprints = PayloadFingerprints("shipId", ("numberPlate", "shipName", "shipType", "shipStatus"))
+
+# Отправления кораблей за последнюю минуту: по ним стадия игроков находит пассажиров
+departures = DepartureIndex()
+
+# Замеры прогресса летящих кораблей, по ним раз в тик считается время прибытия
+progress_samples = ProgressSamples()
+
+guild_stats_executor = ThreadPoolExecutor(max_workers=GUILD_STATS_WORKERS, thread_name_prefix="guild_stats")
+guild_stats_hashes: Dict[int, int] = {}  # guild.id -> hash табло без строки "Updated on", которое сейчас в чате
+guild_stats_sending: Dict[int, datetime.datetime] = {}  # guild.id -> когда поставлено первое сообщение табло
+GUILD_STATS_SEND_TIMEOUT = datetime.timedelta(minutes=5)  # После этого неотправленное первое сообщение ставится снова
 
 
 def update_all(*args, **kwargs):
+    responses = ExpeditionAPI.fetch_all("ships", "users", streams=("users",) if STREAM_USERS else ())
+    now = get_current_datetime()  # Общее время тика для отправлений кораблей и вылетов игроков
     try:
-        update_ships()
+        update_ships(ships=responses.get("ships"), report_changes=True, now=now)
     except Exception:
+        ExpeditionAPI.reset_validators("ships")
         logging.error("Error in updating ships: {}".format(traceback.format_exc()))
 
     try:
-        update_tops()
+        update_tops(users=responses.get("users"), now=now)
     except Exception:
+        ExpeditionAPI.reset_validators("users")
         logging.error("Error in updating users: {}".format(traceback.format_exc()))
 
-    list(map(lambda guild_id: update_guild_stats(dispatcher.bot, guild_id), Guild.GUILD_IDS))
+    try:
+        publish_snapshot()
+    except Exception:
+        logging.error("Error in publishing snapshot: {}".format(traceback.format_exc()))
 
+    # Табло гильдий собираются и отправляются параллельно, время тика не растёт с числом гильдий
+    futures = list(map(lambda guild_id: guild_stats_executor.submit(update_guild_stats, dispatcher.bot, guild_id),
+                       Guild.GUILD_IDS))
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            logging.error("Error in updating guild stats: {}".format(traceback.format_exc()))
 
-def update_tops(*args, **kwargs):
+
+@provide_session
+def publish_snapshot(session):
+    """
+    Публикует снапшот мира после тика, команды чтения отвечают из него без запросов в базу
+    """
+    publish(WorldSnapshot.build(session))
+
+
+def maintain_history_partitions(*args, **kwargs):
+    """
+    Создаёт партиции истории на ближайшие месяцы и применяет политику хранения
+    """
+    session = SessionMaker()
     try:
-        users: Dict = ExpeditionAPI.get_users()
+        today = get_current_datetime().date()
+        ensure_partitions(session, today)
+        # Новые партиции фиксируются отдельно: ошибка политики хранения не должна откатить их создание
+        session.commit()
+        if history_retention_months is not None:
+            apply_retention(session, today, history_retention_months, history_archive_schema)
+            session.commit()
+    except Exception:
+        logging.error("Error in maintaining history partitions: {}".format(traceback.format_exc()))
+    finally:
+        session.close()
+
+
+def update_tops(*args, users: Future = None, now: datetime.datetime = None, **kwargs):
+    """
+    :param users: Уже запущенный запрос /users (ExpeditionAPI.fetch_all), иначе запрос делается здесь.
+                  Результат - либо весь ответ, либо итератор по игрокам (потоковый режим)
+    :param now: Время тика
+    """
+    now = now or get_current_datetime()
+    try:
+        users = users.result() if users is not None else ExpeditionAPI.get_users(stream=STREAM_USERS)
     except RuntimeError:
         pass
     else:
         session = SessionMaker()
         logging.info("Updating players")
-        for user in users.get("users"):
-            rank, user_id, user_name, exp, lvl, faction, location_name = \
-                user.get("rank"), user.get("userId"), user.get("userName"), user.get("exp"), user.get("lvl"), \
-                user.get("faction"), user.get("location")
-            location = Location.get_create_location(location_name, session)
-            player = Player.get_create_player(game_id=user_id, session=session)
-            if location.is_space:
-                if player.location and not player.location.is_space:
-                    # Игрок только что вылетел
-                    ships = player.location.outgoing_ships
-                    player.possible_ships = list(filter(lambda ship: ship.departed_now, ships))
-                    session.add(player)
-                    session.commit()
-
-            player.check_update_data(exp, lvl, rank, location, faction, user_name, session)
-        session.close()
-        logging.info("Players updated")
-
-
-def update_ships(*args, **kwargs):
+        try:
+            users = users.get("users") if isinstance(users, dict) else users
+            history = PlayerHistoryWriter()
+            departed_ships = load_departed_ships(session, now)
+            moved_players, touched_ships = set(), set()
+            # Игроки обрабатываются пачками: память на тик не растёт вместе с таблицей, а коммит остаётся одним
+            for batch in chunks(users_fingerprints.filter_changed(users), INGEST_BATCH_SIZE):
+                batch_players, batch_ships = update_players_batch(batch, session, history, departed_ships)
+                moved_players.update(batch_players)
+                touched_ships.update(batch_ships)
+                session.flush()
+                history.write(session)
+            # Вылеты и крушения этого тика -> денормализованные текущий корабль, пассажиры и флаг крушения
+            Player.refresh_current_ships(session, moved_players)
+            Ship.refresh_status_columns(session, touched_ships)
+            session.commit()
+            users_fingerprints.commit()
+        finally:
+            session.close()
+        logging.info("Players updated ({} processed, {} skipped)".format(
+            users_fingerprints.processed, users_fingerprints.skipped))
+
+
+def load_departed_ships(session, now: datetime.datetime) -> Dict[int, List[Ship]]:
+    """
+    Корабли, отправившиеся в окне тика, одним запросом
+    :return: {origin_id: [Ship]}
+    """
+    if not departures.loaded:
+        departures.load(session, now)
+    departed = departures.by_origin(now)
+    ship_ids = [ship_id for ship_ids in departed.values() for ship_id in ship_ids]
+    ships = {ship.id: ship for ship in session.query(Ship).filter(Ship.id.in_(ship_ids))} if ship_ids else {}
+    return {origin_id: [ships.get(ship_id) for ship_id in ship_ids if ship_id in ships]
+            for origin_id, ship_ids in departed.items()}
+
+
+def update_players_batch(users: List[Dict], session, history: PlayerHistoryWriter = None,
+                         departed_ships: Dict[int, List[Ship]] = None) -> Tuple[Set[int], Set[int]]:
+    """
+    :param departed_ships: {origin_id: [Ship]} - корабли, отправившиеся в этом тике (load_departed_ships)
+    :return: (id игроков, сменивших локацию; id кораблей, у которых могли измениться пассажиры или разбившиеся)
+    """
+    moved_players, touched_ships = set(), set()
+    # Игроки пачки загружаются одним запросом, недостающие создаются одним запросом
+    game_ids = list(map(lambda user: user.get("userId"), users))
+    players = Player.load_players(session, game_ids)
+    players.update(Player.create_players(filter(lambda game_id: game_id not in players, game_ids), session))
+    for user in users:
+        rank, user_id, user_name, exp, lvl, faction, location_name = \
+            user.get("rank"), user.get("userId"), user.get("userName"), user.get("exp"), user.get("lvl"), \
+            user.get("faction"), user.get("location")
+        location_id = Location.get_location_id(location_name)
+        player = players.get(user_id)
+        if location_id != player.location_id:
+            moved_players.add(player.id)
+            if Location.is_space_id(player.location_id) and not Location.is_space_id(location_id):
+                # Игрок приземлился: он пропадёт из пассажиров (и, возможно, попадёт в разбившиеся) своих кораблей
+                touched_ships.update(map(lambda ship: ship.id, player.possible_ships))
+        if Location.is_space_id(location_id):
+            if player.location_id is not None and not Location.is_space_id(player.location_id):
+                # Игрок только что вылетел
+                player.possible_ships = list((departed_ships or {}).get(player.location_id, []))
+                touched_ships.update(map(lambda ship: ship.id, player.possible_ships))
+
+        player.check_update_data(exp, lvl, rank, location_id, faction, user_name, session, commit=False,
+                                 history=history)
+    return moved_players, touched_ships
+
+
+def update_ships(*args, ships: Future = None, report_changes: bool = False, now: datetime.datetime = None,
+                 **kwargs):
+    """
+    :param ships: Уже запущенный запрос /ships (ExpeditionAPI.fetch_all), иначе запрос делается здесь
+    :param report_changes: Посчитать и залогировать число реально изменившихся кораблей
+    :param now: Время тика, оно же время отправления кораблей
+    :return: Число изменившихся кораблей, если report_changes, иначе None
+    """
+    now = now or get_current_datetime()
     try:
-        ships: Dict = ExpeditionAPI.get_ships()
+        ships: Dict = ships.result() if ships is not None else ExpeditionAPI.get_ships()
     except RuntimeError:
         pass
     else:
         session = SessionMaker()
         logging.info("Updating ships")
-        for ship in ships.get("ships"):
-            ship_id, code, name, ship_type, status = ship.get("shipId"), ship.get("numberPlate"), ship.get("shipName"),\
-                                                     ship.get("shipType"), ship.get("shipStatus")
-            ship = Ship.get_create_ship(ship_id, session)
-            if ship.status in {"preparing", "launching"}:
-                if "underway" in status:
-                    ship.departed_date = get_current_datetime()
-                elif ship.status == "preparing" and "launching" in status:
-                    # Корабль начал отправляться
-                    ship.crashed_players.clear()
-                    for player in ship.subscribed_players:
-                        if player.telegram_id:
-                            dispatcher.bot.send_message(
-                                chat_id=player.telegram_id,
-                                text="🚀<b>{} {}</b> скоро отправится к <b>{}</b>".format(
-                                    ship.code, ship.name, ship.destination.name),
-                                parse_mode='HTML'
-                            )
-                    ship.subscribed_players.clear()
-            ship.name = name
-            ship.code = code
-            ship.type = ship_type
-            ship.status = status
-            ship.determine_locations(session)
-        session.close()
-        logging.info("Ships updated")
+        changed = None
+        departed = []
+        try:
+            feed_ship_ids = list(map(lambda ship: ship.get("shipId"), ships.get("ships")))
+            ships = list(ships_fingerprints.filter_changed(ships.get("ships")))
+            # Все корабли загружаются один раз за тик, изменения пишутся одним коммитом
+            existing_ships = Ship.load_ships(session, map(lambda ship: ship.get("shipId"), ships))
+            new_ships = Ship.create_ships(
+                filter(lambda ship_id: ship_id not in existing_ships, map(lambda ship: ship.get("shipId"), ships)),
+                session)
+            existing_ships.update(new_ships)
+            for ship in ships:
+                ship_id, code, name, ship_type, status = ship.get("shipId"), ship.get("numberPlate"), \
+                                                         ship.get("shipName"), ship.get("shipType"), \
+                                                         ship.get("shipStatus")
+                ship = existing_ships.get(ship_id)
+                if ship.status in {"preparing", "launching"}:
+                    if "underway" in status:
+                        ship.departed_date = now
+                        departed.append(ship)
+                    elif ship.status == "preparing" and "launching" in status:
+                        # Корабль начал отправляться. Уведомления пишутся в outbox в этой же транзакции,
+                        # отправляет их отдельная стадия (bin/notifications.py)
+                        ship.crashed_players.clear()
+                        for player in ship.subscribed_players:
+                            if player.telegram_id:
+                                session.add(Notification(
+                                    chat_id=player.telegram_id,
+                                    text="🚀<b>{} {}</b> скоро отправится к <b>{}</b>".format(
+                                        ship.code, ship.name, ship.destination_info.name),
+                                    parse_mode='HTML', created_date=now
+                                ))
+                        ship.subscribed_players.clear()
+                ship.name = name
+                ship.code = code
+                ship.type = ship_type
+                ship.status = status
+                ship.determine_locations(session, commit=False)
+                if ship.status == "underway" and ship.progress is not None:
+                    # Замер (отправление, 0%) только для отправления этого тика: старый departed_date - от прошлого полёта
+                    progress_samples.add(ship.id, now, ship.progress,
+                                         ship.departed_date if ship.departed_date == now else None)
+                else:
+                    progress_samples.discard(ship.id)
+                    ship.arrival_date = None
+            # Прогноз прибытия для всех кораблей с новыми замерами - одним пакетным расчётом
+            ships_by_id = {ship.id: ship for ship in existing_ships.values()}
+            for ship_id, arrival_date in progress_samples.estimate(now, ships_by_id.keys()).items():
+                if arrival_date is not None:
+                    ships_by_id.get(ship_id).arrival_date = arrival_date
+            if report_changes:
+                changed = len(new_ships) + len(list(filter(
+                    lambda ship: ship.ship_id not in new_ships and session.is_modified(ship),
+                    existing_ships.values())))
+            departed = list(map(lambda ship: (ship.id, ship.origin_id), departed))
+            # Разбившиеся очищаются только у обработанных в этом тике кораблей
+            Ship.refresh_status_columns(session, map(lambda ship: ship.id, existing_ships.values()))
+            session.commit()
+            ships_fingerprints.commit()
+            # Замеры нужны только летящим кораблям из ответа API, остальные не копятся в памяти
+            progress_samples.prune(map(lambda row: row[0], session.query(Ship.id).filter(
+                Ship.ship_id.in_(feed_ship_ids), Ship.status == "underway")))
+        finally:
+            session.close()
+        for ship_id, origin_id in departed:
+            departures.record(ship_id, origin_id, now)
+        departures.prune(now)
+        logging.info("Ships updated ({} processed, {} skipped{})".format(
+            ships_fingerprints.processed, ships_fingerprints.skipped,
+            ", {} changed".format(changed) if changed is not None else ""))
+        return changed
+
+
+def like_prefix(text: str) -> str:
+    """
+    Шаблон LIKE 'text%' в нижнем регистре - использует индекс lower(...) text_pattern_ops.
+    Обратная косая черта - экранирующий символ LIKE по умолчанию в PostgreSQL
+    """
+    return text.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def search_players_query(name: str, session):
+    """
+    Поиск игроков по началу ника в базе: точное совпадение первым, затем по уровню
+    """
+    return session.query(Player).filter(func.lower(Player.username).like(like_prefix(name))).\
+        order_by((func.lower(Player.username) == name.lower()).desc()).order_by(Player.lvl.desc())
+
+
+def similar_filter(column: str, name: str):
+    """
+    Имена, похожие на name (оператор pg_trgm %, порог pg_trgm.similarity_threshold) - использует индекс
+    lower(...) gin_trgm_ops. Через text(), чтобы % был экранирован для psycopg2
+    """
+    return sql_text("lower({}) % :similar_name".format(column)).bindparams(similar_name=name.lower())
+
+
+def search_players(name: str, session, limit: int) -> List[Player]:
+    """
+    Как WorldSnapshot.player_index.search, но в базе: по началу ника, если ничего нет - похожие ники
+    """
+    players = search_players_query(name, session).limit(limit).all()
+    if players:
+        return players
+    return session.query(Player).filter(similar_filter("players.username", name)).\
+        order_by(func.similarity(func.lower(Player.username), name.lower()).desc()).limit(limit).all()
+
+
+def search_ship(code: str, session) -> Optional[Ship]:
+    """
+    Корабль по началу кода, если такого нет - с самым похожим кодом
+    """
+    ship = session.query(Ship).filter(func.lower(Ship.code).like(like_prefix(code))).\
+        order_by((func.lower(Ship.code) == code.lower()).desc()).order_by(Ship.code).first()
+    if ship is not None:
+        return ship
+    return session.query(Ship).filter(similar_filter("ships.code", code)).\
+        order_by(func.similarity(func.lower(Ship.code), code.lower()).desc()).first()
 
 
 @provide_session
@@ -107,12 +337,17 @@ def spy(bot, update, session):
         user_name = update.message.text.split()[1]
     except (TypeError, IndexError):
         return
-    player = session.query(Player).filter(Player.username.ilike("{}%".format(user_name))).first()
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        player = snapshot.find_player(user_name)
+    else:
+        players = search_players(user_name, session, limit=1)
+        player = players[0] if players else None
     if player is None:
         bot.send_message(chat_id=update.message.chat_id, text="Игрок не найден.")
         return
     response = "[{}] <b>{}</b>\n#{} 🏅{}\n".format(player.faction, player.username, player.rank, player.lvl)
-    if player.location.is_space:
+    if Location.is_space_id(player.location_id):
         response += "<b>🚀В пути</b> "
         if not player.possible_ships:
             response += "(Неизвестно)\n"
@@ -125,7 +360,7 @@ def spy(bot, update, session):
                 "    " + "\n    ".join(map(lambda possible_ship: possible_ship.format_short(), player.possible_ships))
             ) + "\n"
     else:
-        response += "<b>{}</b>\n".format(player.location.name)
+        response += "<b>{}</b>\n".format(player.location_info.name)
     response += "\nИстория перемещений: /pl_history_{}".format(player.id)
     bot.send_message(chat_id=update.message.chat_id, text=response, parse_mode='HTML')
 
@@ -136,24 +371,57 @@ def player_history(bot, update, session):
     if parse is None:
         bot.send_message(chat_id=update.message.chat_id, text="Неверный синтаксис.")
         return
-    player: Player = session.query(Player).get(int(parse.group(1)))
-    if player is None:
+    player_id, days = int(parse.group(1)), int(parse.group(3) or 1)
+    pages = format_player_history(player_id, days, session)
+    if pages is None:
         bot.send_message(chat_id=update.message.chat_id, text="Игрок не найден.")
         return
-    days = int(parse.group(3) or 1)
-    response = "Перемещения <b>{}</b> за {} дней:\n".format(player.username, days)
+    bot.send_message(chat_id=update.message.chat_id, text=pages[0], parse_mode='HTML',
+                     reply_markup=make_pages_keyboard("plh_{}_{}".format(player_id, days), 0, len(pages)))
 
-    changes = list(sorted(filter(lambda change: get_current_datetime() - change.date <= datetime.timedelta(days=days),
-                   player.location_changes), key=lambda change: change.date, reverse=False))
-    if changes and changes[0].location.is_space:
+
+@provide_session
+def player_history_page(bot, update, session):
+    player_id, days, page = map(int, re.match("plh_(\\d+)_(\\d+)_(\\d+)", update.callback_query.data).groups())
+    pages = format_player_history(player_id, days, session)
+    bot.answerCallbackQuery(callback_query_id=update.callback_query.id)
+    if pages is None:
+        return
+    page = min(page, len(pages) - 1)
+    try:
+        bot.editMessageText(chat_id=update.callback_query.message.chat_id,
+                            message_id=update.callback_query.message.message_id, text=pages[page], parse_mode='HTML',
+                            reply_markup=make_pages_keyboard("plh_{}_{}".format(player_id, days), page, len(pages)))
+    except BadRequest:
+        # Страница не изменилась
+        pass
+
+
+def format_player_history(player_id: int, days: int, session) -> List[str]:
+    """
+    Перемещения игрока за days дней, разбитые на страницы.
+    Окно по дате и сортировка выполняются в базе по индексу (player_id, date), названия локаций берутся из реестра
+    :return: Страницы или None, если игрок не найден
+    """
+    player = session.query(Player.id, Player.username).filter(Player.id == player_id).first()
+    if player is None:
+        return None
+    header = "Перемещения <b>{}</b> за {} дней:\n".format(player.username, days)
+
+    changes = session.query(PlayerLocationChanges.new_location_id, PlayerLocationChanges.date).\
+        filter(PlayerLocationChanges.player_id == player_id).\
+        filter(PlayerLocationChanges.date >= get_current_datetime() - datetime.timedelta(days=days)).\
+        order_by(PlayerLocationChanges.date).all()
+    if changes and Location.is_space_id(changes[0].new_location_id):
         changes = changes[1:]
+    lines = []
     for current, space, previous in zip(changes[::2], changes[1::2], changes[2::2]):
-        if not space.location.is_space:
+        if not Location.is_space_id(space.new_location_id):
             continue
-        response += "{} -> {} ({} -> {})\n".format(current.location.name, previous.location.name,
-                                                   pretty_time_format(space.date), pretty_time_format(previous.date))
-
-    bot.send_message(chat_id=update.message.chat_id, text=response, parse_mode='HTML')
+        lines.append("{} -> {} ({} -> {})\n".format(Location.get_name(current.new_location_id),
+                                                    Location.get_name(previous.new_location_id),
+                                                    pretty_time_format(space.date), pretty_time_format(previous.date)))
+    return split_pages(header, lines)
 
 
 @provide_session
@@ -163,65 +431,134 @@ def view_players(bot, update, session):
         location_name = update.message.text.split()[1]
         if location_name.lower() in factions:
             faction = location_name.lower()
-            players = session.query(Player).filter(func.lower(Player.faction) == faction).all()
         else:
-            location = Location.search_location(location_name, session)
+            location = Location.search_location(location_name)
             if location is None:
                 bot.send_message(chat_id=update.message.chat_id, text="Локация не найдена.")
                 return
-            players = session.query(Player).filter_by(location=location).limit(50).all()
     except (TypeError, IndexError):
-        players = session.query(Player).limit(100).all()
-    response = "Игроки {}на <b>{}</b>:\n".format("{} ".format(faction.upper()) if faction else "",
-                                                 location.name if location else "сервере")
-    for player in sorted(players, key=lambda player: (player.lvl, player.exp), reverse=True):
-        response += player.short_format()
-    bot.send_message(chat_id=update.message.chat_id, text=response, parse_mode="HTML")
+        pass
+    snapshot = get_snapshot()
+    token, pages = page_cache.get_or_render(
+        ("players", faction, location.id if location else None, snapshot.created) if snapshot is not None else None,
+        lambda: format_players(select_players(faction, location, snapshot, session), faction, location)
+    )
+    send_pages(bot, update.message.chat_id, token, pages)
+
+
+def select_players(faction, location, snapshot, session) -> List:
+    if faction:
+        if snapshot is not None:
+            return snapshot.players_by_faction.get(faction, [])
+        return session.query(Player).filter(func.lower(Player.faction) == faction).all()
+    if location:
+        if snapshot is not None:
+            return snapshot.players_by_location.get(location.id, [])[:50]
+        return session.query(Player).filter_by(location_id=location.id).limit(50).all()
+    if snapshot is not None:
+        return list(snapshot.players.values())[:100]
+    return session.query(Player).limit(100).all()
+
+
+def format_players(players, faction, location) -> List[str]:
+    header = "Игроки {}на <b>{}</b>:\n".format("{} ".format(faction.upper()) if faction else "",
+                                               location.name if location else "сервере")
+    return split_pages(header, map(lambda player: player.short_format(),
+                                   sorted(players, key=lambda player: (player.lvl, player.exp), reverse=True)))
+
+
+def view_page(bot, update):
+    """
+    Листание страниц ответа из page_cache (callback_data = pg_{token}_{page})
+    """
+    parse = re.fullmatch("pg_({})_(\\d+)".format(PageCache.TOKEN_PATTERN), update.callback_query.data)
+    # Кнопки старого формата и списки, вытесненные из кэша или собранные до перезапуска, не открываются
+    token, page = (parse.group(1), int(parse.group(2))) if parse is not None else (None, 0)
+    pages = page_cache.get(token) if token is not None else None
+    if pages is None:
+        bot.answerCallbackQuery(callback_query_id=update.callback_query.id, text="Список устарел, повторите команду.")
+        return
+    bot.answerCallbackQuery(callback_query_id=update.callback_query.id)
+    page = min(page, len(pages) - 1)
+    try:
+        bot.editMessageText(chat_id=update.callback_query.message.chat_id,
+                            message_id=update.callback_query.message.message_id, text=pages[page], parse_mode='HTML',
+                            reply_markup=make_pages_keyboard("pg_{}".format(token), page, len(pages)))
+    except BadRequest:
+        # Страница не изменилась
+        pass
 
 
 @provide_session
 def update_guild_stats(bot, guild_id: int, session):
-    ships = []
     guild = session.query(Guild).get(guild_id)
     if guild is None or not guild.chat_id:
         return
+    # Текущие корабли подгружаются тем же запросом (players.current_ship_id), локации берутся из реестра
+    query = session.query(Player).options(joinedload(Player.current_ship))
     if guild.is_faction:
-        players = session.query(Player).filter_by(faction=guild.name).order_by(Player.lvl.desc()).\
-            order_by(Player.exp.desc()).all()
+        query = query.filter_by(faction=guild.name)
     else:
-        players = session.query(Player).filter_by(guild=guild).order_by(Player.lvl.desc()).\
-            order_by(Player.exp.desc()).all()
-    response = ""
-    for player in players:
-        index = None
-        if player.location.is_space and player.possible_ships:
-            ship = player.possible_ships[0]
-            if ship in ships:
-                index = ships.index(ship) + 1
-            else:
-                ships.append(ship)
-                index = len(ships)
-        response += "🏅{} <code>{:11}</code> {}\n".format(
-            player.lvl, player.username,
-            ("🪐{}".format(player.location.name)) if not player.location.is_space else (
-                "🚀{}{}".format(translate_number_to_emoji(index) if index else "", "{} -> {} ({}%)".format(
-                    player.possible_ships[0].origin.name, player.possible_ships[0].destination.name,
-                    player.possible_ships[0].progress) if player.possible_ships else ""
-        )))
-    if ships:
-        response += "\nShips:\n"
-        for i, ship in enumerate(ships, start=1):
-            response += "{} {} -> {} ({}% - {})\n".format(
-                translate_number_to_emoji(i), ship.origin.name, ship.destination.name, ship.progress,
-                pretty_datetime_format_short(ship.calculate_arrival()))
+        query = query.filter_by(guild_id=guild.id)
+    players = query.order_by(Player.lvl.desc()).order_by(Player.exp.desc()).all()
+    response = format_guild_stats(players)
+    body_hash = hash(response)
+    if guild.stats_message_id and guild_stats_hashes.get(guild.id) == body_hash:
+        # Ничего, кроме времени обновления, не изменилось - не тратим запрос к Telegram
+        return
     response += "\nUpdated on {}\n".format(pretty_time_format(get_current_datetime()))
+    # Табло уходят через очередь AsyncBot с приоритетом ниже ответов на команды, hash запоминается после отправки
     if guild.stats_message_id:
-        bot.editMessageText(chat_id=guild.chat_id, message_id=guild.stats_message_id, text=response, parse_mode='HTML')
+        bot.editMessageTextRestricted(chat_id=guild.chat_id, message_id=guild.stats_message_id, text=response,
+                                      parse_mode='HTML', priority=PRIORITY_BOARD,
+                                      on_sent=on_guild_stats_sent, on_sent_args=[guild.id, body_hash])
     else:
-        message = bot.sync_send_message(chat_id=guild.chat_id, text=response, parse_mode='HTML')
-        guild.stats_message_id = message.message_id
-        session.add(guild)
-        session.commit()
+        sending = guild_stats_sending.get(guild.id)
+        if sending is not None and get_current_datetime() - sending < GUILD_STATS_SEND_TIMEOUT:
+            # Первое сообщение табло ещё не отправлено - не создаём второе
+            return
+        guild_stats_sending.update({guild.id: get_current_datetime()})
+        bot.send_message(chat_id=guild.chat_id, text=response, parse_mode='HTML', priority=PRIORITY_BOARD,
+                         on_sent=on_guild_stats_created, on_sent_args=[guild.id, body_hash])
+
+
+def on_guild_stats_sent(message, guild_id: int, body_hash: int):
+    guild_stats_hashes.update({guild_id: body_hash})
+
+
+@provide_session
+def on_guild_stats_created(message, guild_id: int, body_hash: int, session):
+    guild = session.query(Guild).get(guild_id)
+    guild.stats_message_id = message.message_id
+    session.add(guild)
+    session.commit()
+    guild_stats_sending.pop(guild_id, None)
+    guild_stats_hashes.update({guild_id: body_hash})
+
+
+def format_guild_stats(players) -> str:
+    ships = {}  # ship.id -> (номер, ship)
+    lines = []
+    for player in players:
+        if not Location.is_space_id(player.location_id):
+            lines.append("🏅{} <code>{:11}</code> 🪐{}\n".format(player.lvl, player.username, player.location_info.name))
+            continue
+        ship = player.current_ship
+        index = None
+        if ship is not None:
+            index = ships.setdefault(ship.id, (len(ships) + 1, ship))[0]
+        lines.append("🏅{} <code>{:11}</code> 🚀{}{}\n".format(
+            player.lvl, player.username, translate_number_to_emoji(index) if index else "",
+            "{} -> {} ({}%)".format(ship.origin_info.name, ship.destination_info.name, ship.progress)
+            if ship is not None else ""
+        ))
+    if ships:
+        lines.append("\nShips:\n")
+        for index, ship in ships.values():
+            lines.append("{} {} -> {} ({}% - {})\n".format(
+                translate_number_to_emoji(index), ship.origin_info.name, ship.destination_info.name, ship.progress,
+                pretty_datetime_format_short(ship.calculate_arrival())))
+    return "".join(lines)
 
 
 @provide_session
@@ -229,65 +566,82 @@ def view_ships(bot, update, session):
     location = None
     try:
         location_name = update.message.text.split()[1]
-        location = Location.search_location(location_name, session)
+        location = Location.search_location(location_name)
         if location is None:
             bot.send_message(chat_id=update.message.chat_id, text="Локация не найдена.")
             return
-        ships = session.query(Ship).filter(or_(
-            Ship.origin_id == location.id, Ship.destination_id == location.id)
-        ).order_by(Ship.destination_id).order_by(Ship.origin_id).order_by(Ship.status).all()
     except (TypeError, IndexError):
-        ships = session.query(Ship).order_by(Ship.origin_id).order_by(Ship.destination_id).all()
+        pass
+    snapshot = get_snapshot()
+
+    def render():
+        ships = select_ships(location, snapshot, session)
+        return format_location_ships(location, ships) if location else format_all_ships(ships)
 
+    token, pages = page_cache.get_or_render(
+        ("ships", location.id if location else None, snapshot.created) if snapshot is not None else None, render)
+    send_pages(bot, update.message.chat_id, token, pages)
+
+
+def select_ships(location, snapshot, session) -> List:
     if location:
-        response = format_location_ships(location, ships)
-    else:
-        response = format_all_ships(ships)
-    bot.send_message(chat_id=update.message.chat_id, text=response, parse_mode='HTML')
+        if snapshot is not None:
+            return sorted(snapshot.ships_by_location.get(location.id, []),
+                          key=lambda ship: nulls_last(ship.destination_id, ship.origin_id, ship.status))
+        return session.query(Ship).filter(or_(
+            Ship.origin_id == location.id, Ship.destination_id == location.id)
+        ).order_by(Ship.destination_id).order_by(Ship.origin_id).order_by(Ship.status).all()
+    if snapshot is not None:
+        return sorted(snapshot.ships.values(), key=lambda ship: nulls_last(ship.origin_id, ship.destination_id))
+    return session.query(Ship).order_by(Ship.origin_id).order_by(Ship.destination_id).all()
 
 
-def format_all_ships(ships):
-    response = "Все корабли в игре:"
+def format_all_ships(ships) -> List[str]:
+    lines = []
     origin_id = None
     for ship in ships:
+        separator = ""
         if ship.origin_id != origin_id:
+            # Пустая строка между локациями отправления (заголовок уже заканчивается переводом строки)
+            separator = "\n" if lines else ""
             origin_id = ship.origin_id
-            response += "\n"
 
-        response += "{}<code>{}</code> {} -> {} {} /sh_{}\n".format(
-            ship.status_emoji, ship.code, ship.origin.name, ship.destination.name,
+        lines.append("{}{}<code>{}</code> {} -> {} {} /sh_{}\n".format(
+            separator, ship.status_emoji, ship.code, ship.origin_info.name, ship.destination_info.name,
             "({}% {})".format(int(ship.progress),
                               pretty_time_format(ship.departed_date) if ship.departed_date else "")
             if ship.progress is not None else "", ship.id
-        )
-    return response
+        ))
+    return split_pages("Все корабли в игре:\n", lines)
 
 
-def format_location_ships(location, ships) -> str:
-    response = "Корабли в {}:\n".format(location.name)
+def format_location_ships(location, ships) -> List[str]:
+    lines = []
     outgoing = list(filter(lambda ship: ship.origin_id == location.id, ships))
     incoming = list(filter(lambda ship: ship.destination_id == location.id, ships))
 
     if outgoing:
-        response += "🛫Отбытие\n"
-        for ship in outgoing:
-            response += ship.format_line()
-        response += "\n"
+        lines.append("🛫Отбытие\n")
+        lines.extend(map(lambda ship: ship.format_line(), outgoing))
+        lines.append("\n")
 
     if incoming:
-        response += "🛫Прибытие\n"
-        for ship in incoming:
-            response += ship.format_line(outgoing=False)
-    return response
+        lines.append("🛫Прибытие\n")
+        lines.extend(map(lambda ship: ship.format_line(outgoing=False), incoming))
+    return split_pages("Корабли в {}:\n".format(location.name), lines)
 
 
 @provide_session
 def view_ship(bot, update, session):
     parse = re.match("/sh_(\\d+)", update.message.text)
+    snapshot = get_snapshot()
     if parse is None:
         try:
             code = update.message.text.split()[1]
-            ship = session.query(Ship).filter(Ship.code.ilike("{}%".format(code))).first()
+            if snapshot is not None:
+                ship = snapshot.find_ship(code)
+            else:
+                ship = search_ship(code, session)
             if ship is None:
                 raise ValueError
         except (TypeError, ValueError):
@@ -295,26 +649,23 @@ def view_ship(bot, update, session):
             return
     else:
         ship_id = int(parse.group(1))
-        ship = session.query(Ship).get(ship_id)
+        ship = snapshot.ships.get(ship_id) if snapshot is not None else session.query(Ship).get(ship_id)
     if ship is None:
         bot.send_message(chat_id=update.message.chat_id, text="Корабль не найден.")
         return
 
     response = "<b>{} {}</b>\n".format(ship.code, ship.name)
-    response += "{} -> {}\n".format(ship.origin.name, ship.destination.name)
+    response += "{} -> {}\n".format(ship.origin_info.name, ship.destination_info.name)
     response += "{}{}\n".format(
-        ship.status_emoji, ship.status if not ship.crashed_players else ship.status + " ( 💥crashed? )")
+        ship.status_emoji, ship.status if not ship.crashed else ship.status + " ( 💥crashed? )")
     if ship.progress:
         response += "{}\n".format(make_progressbar(ship.progress))
         response += "{}% {}\n".format(ship.progress, "- departed {}".format(
             pretty_datetime_format_short(ship.departed_date)) if ship.departed_date else ""
         )
-        if ship.departed_date:
-            response += "Прибытие: {}\n".format(
-                pretty_datetime_format_short(
-                    ship.calculate_arrival(),
-                )
-            )
+        arrival_date = ship.calculate_arrival()
+        if arrival_date:
+            response += "Прибытие: {}\n".format(pretty_datetime_format_short(arrival_date))
     if ship.possible_players:
         response += "\nПассажиры:\n"
         for player in ship.possible_players:
@@ -343,8 +694,12 @@ def register(bot, update, session, args):
     if not args:
         bot.send_message(chat_id=update.message.chat_id, text="Неверный синтаксис.\nПример: /register vamik76")
         return
-    players = session.query(Player).filter(Player.username.ilike("{}%".format(" ".join(args)))).all()
-    if players is None:
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        players = snapshot.player_index.search(" ".join(args), limit=REGISTER_SEARCH_LIMIT)
+    else:
+        players = search_players(" ".join(args), session, limit=REGISTER_SEARCH_LIMIT)
+    if not players:
         bot.send_message(chat_id=update.message.chat_id, text="Игрок не найден.")
         return
     response = "Найденные игроки:\n{}".format("\n".join(map(lambda player: "{} /register_{}".format(player.username, player.id), players)))
@@ -381,25 +736,25 @@ def sub(bot, update, session, player, args):
                          text="Команда доступна только зарегистрированным пользователям.\nУкажите свой ник в игре "
                               "(пример: /register vamik76)")
         return
-    location = Location.search_location(args[0], session)
+    location = Location.search_location(args[0])
     if not location or location.is_space:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Локация не найдена.")
         return
-    if not player.location:
+    if player.location_id is None:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Местоположения игрока не определено.\n(Неизвестная ошибка)")
         return
-    if player.location.is_space:
+    if Location.is_space_id(player.location_id):
         bot.send_message(chat_id=update.message.chat_id,
                          text="Команду можно использовать только находясь на планете (не в космосе)")
         return
-    ships: List = session.query(Ship).filter_by(origin=player.location).filter_by(status="preparing").\
-        filter_by(destination=location).all()
+    ships: List = session.query(Ship).filter_by(origin_id=player.location_id).filter_by(status="preparing").\
+        filter_by(destination_id=location.id).all()
     if not ships:
         bot.send_message(chat_id=update.message.chat_id,
                          text="Ожидающие корабли по маршруту <b>{}</b> -> <b>{}</b> не найдены.".format(
-                             player.location.name, location.name))
+                             player.location_info.name, location.name))
         return
     if len(ships) == 1:
         ship = ships[0]
@@ -413,7 +768,7 @@ def sub(bot, update, session, player, args):
     else:
         ships.sort(key=lambda sh: sh.type)
         bot.send_message(chat_id=update.message.chat_id, text="Выберите корабль ({} -> {}):\n{}".format(
-            player.location.name, location.name,
+            player.location_info.name, location.name,
             "\n".join(
                 map(lambda ship: "{} {} {}".format(ship.code, ship.name, "/sub_{}".format(ship.id)), ships)))
         )
@@ -0,0 +1,48 @@
+from sqlalchemy import text
+
+from resources.globals import SessionMaker
+
+from libs.models.Location import Location
+from libs.models.Player import Player
+from libs.models.Ship import Ship
+
+from typing import Dict, List
+
+import logging
+import traceback
+
+
+def find_inconsistencies(session) -> Dict[str, List[int]]:
+    """
+    Сверяет денормализованные колонки с таблицами связей (suitable_ships, crashed_ships)
+    :return: {"ships": [ships.id], "players": [players.id]} - строки, расходящиеся с таблицами связей
+    """
+    ships = session.execute(text(
+        "SELECT ships.id FROM ships JOIN ({}) AS actual ON ships.id = actual.id WHERE {} ORDER BY ships.id".format(
+            Ship.STATUS_COLUMNS_SELECT, Ship.STATUS_COLUMNS_MISMATCH)))
+    players = session.execute(text(
+        "SELECT players.id FROM players JOIN ({}) AS actual ON players.id = actual.id WHERE {} "
+        "ORDER BY players.id".format(Player.CURRENT_SHIP_SELECT, Player.CURRENT_SHIP_MISMATCH)),
+        {"space_id": Location.SPACE_ID})
+    return {"ships": list(map(lambda row: row[0], ships)), "players": list(map(lambda row: row[0], players))}
+
+
+def check_consistency(*args, repair: bool = True, **kwargs):
+    """
+    Периодическая проверка денормализованных колонок. Расхождения логируются и, если repair, пересчитываются
+    """
+    session = SessionMaker()
+    try:
+        inconsistencies = find_inconsistencies(session)
+        if not any(inconsistencies.values()):
+            return
+        logging.warning("Denormalized columns are inconsistent: ships {}, players {}".format(
+            inconsistencies.get("ships"), inconsistencies.get("players")))
+        if repair:
+            Player.refresh_current_ships(session, inconsistencies.get("players"))
+            Ship.refresh_status_columns(session, inconsistencies.get("ships"))
+            session.commit()
+    except Exception:
+        logging.error("Error in checking consistency: {}".format(traceback.format_exc()))
+    finally:
+        session.close()
@@ -0,0 +1,50 @@
+from resources.globals import SessionMaker, dispatcher
+
+from libs.models.Notification import Notification
+from libs.bot import PRIORITY_BULK
+
+from bin.service import get_current_datetime
+
+import logging
+import traceback
+
+
+NOTIFICATIONS_INTERVAL = 10  # seconds
+NOTIFICATIONS_BATCH_SIZE = 100
+
+
+def send_notifications(*args, **kwargs):
+    """
+    Стадия отправки outbox: забирает пачку уведомлений, фиксирует передачу и отдаёт их AsyncBot.
+    Доставленные отмечаются из on_sent, недоставленные будут отправлены снова через Notification.DELIVERY_TIMEOUT
+    """
+    session = SessionMaker()
+    try:
+        notifications = Notification.take_pending(session, get_current_datetime(), NOTIFICATIONS_BATCH_SIZE)
+        # Передача фиксируется до отправки: другая стадия не возьмёт уведомление повторно,
+        # а неподтверждённое (ошибка или падение) уйдёт снова по DELIVERY_TIMEOUT
+        pending = list(map(lambda notification: (notification.id, notification.chat_id, notification.text,
+                                                 notification.parse_mode), notifications))
+        session.commit()
+    except Exception:
+        logging.error("Error in taking notifications: {}".format(traceback.format_exc()))
+        return
+    finally:
+        session.close()
+    for notification_id, chat_id, text, parse_mode in pending:
+        dispatcher.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                    on_sent=mark_delivered, on_sent_args=[notification_id], priority=PRIORITY_BULK,
+                                    coalesce=True)
+    if pending:
+        logging.info("Dispatched {} notifications".format(len(pending)))
+
+
+def mark_delivered(message, notification_id: int):
+    session = SessionMaker()
+    try:
+        Notification.mark_delivered(notification_id, session, get_current_datetime())
+        session.commit()
+    except Exception:
+        logging.error("Error in marking notification as delivered: {}".format(traceback.format_exc()))
+    finally:
+        session.close()
@@ -0,0 +1,102 @@
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+from libs.bot import MAX_MESSAGE_LENGTH
+
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import itertools
+import threading
+import time
+
+
+def split_pages(header: str, lines: Iterable[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Разбивает строки на страницы не длиннее limit только по границам строк, заголовок повторяется на каждой странице
+    """
+    pages, page, length = [], [header], len(header)
+    for line in lines:
+        if length + len(line) > limit and len(page) > 1:
+            pages.append("".join(page))
+            page, length = [header], len(header)
+        page.append(line)
+        length += len(line)
+    pages.append("".join(page))
+    return pages
+
+
+def make_pages_keyboard(prefix: str, page: int, pages_count: int):
+    """
+    Клавиатура листания, callback_data = "{prefix}_{page}"
+    """
+    if pages_count <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data="{}_{}".format(prefix, page - 1)))
+    buttons.append(InlineKeyboardButton("{}/{}".format(page + 1, pages_count),
+                                        callback_data="{}_{}".format(prefix, page)))
+    if page < pages_count - 1:
+        buttons.append(InlineKeyboardButton("➡️", callback_data="{}_{}".format(prefix, page + 1)))
+    return InlineKeyboardMarkup([buttons])
+
+
+def send_pages(bot, chat_id: int, token: str, pages: List[str]):
+    """
+    Отправляет первую страницу, остальные листаются кнопками (callback_data = pg_{token}_{page})
+    """
+    bot.send_message(chat_id=chat_id, text=pages[0], parse_mode='HTML',
+                     reply_markup=make_pages_keyboard("pg_{}".format(token), 0, len(pages)))
+
+
+class PageCache:
+    """
+    Страницы ответов, собранные за тик: повторная команда и листание кнопками не пересобирают список.
+    Ключ включает время снапшота, поэтому после нового тика страницы собираются заново, а старые вытесняются.
+    Token начинается со времени запуска процесса: кнопки, оставшиеся от прошлого запуска, не откроют чужой список
+    """
+    TOKEN_PATTERN = "[0-9a-f]+-\\d+"
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pages: Dict[str, List[str]] = OrderedDict()  # token -> страницы
+        self.tokens: Dict[Hashable, str] = {}  # ключ -> token
+        self.keys: Dict[str, Hashable] = {}  # token -> ключ
+        self.generation = "{:x}".format(int(time.time() * 1000))
+        self.counter = itertools.count(1)
+
+    def get(self, token: str) -> Optional[List[str]]:
+        with self.lock:
+            pages = self.pages.get(token)
+            if pages is not None:
+                self.pages.move_to_end(token)
+            return pages
+
+    def get_or_render(self, key: Optional[Hashable], render: Callable[[], List[str]]) -> Tuple[str, List[str]]:
+        """
+        :param key: Ключ ответа в текущем тике; None - не переиспользовать (например, ответ из базы без снапшота)
+        :return: (token для кнопок, страницы)
+        """
+        if key is not None:
+            with self.lock:
+                token = self.tokens.get(key)
+                if token is not None:
+                    self.pages.move_to_end(token)
+                    return token, self.pages.get(token)
+        pages = render()
+        with self.lock:
+            token = "{}-{}".format(self.generation, next(self.counter))
+            self.pages.update({token: pages})
+            if key is not None:
+                self.tokens.update({key: token})
+                self.keys.update({token: key})
+            while len(self.pages) > self.max_size:
+                old_token, _ = self.pages.popitem(last=False)
+                old_key = self.keys.pop(old_token, None)
+                if old_key is not None and self.tokens.get(old_key) == old_token:
+                    self.tokens.pop(old_key)
+        return token, pages
+
+
+page_cache = PageCache()
@@ -1,7 +1,10 @@
 
 from resources.globals import moscow_tz, SessionMaker
 
+from typing import Iterable, Iterator, List
+
 import datetime
+import itertools
 
 
 def get_current_datetime():
@@ -34,6 +37,21 @@ def provide_session(func):
     return wrapper
 
 
+def chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def nulls_last(*values) -> tuple:
+    """
+    Ключ сортировки как ORDER BY ... NULLS LAST (None не сравнивается с другими значениями)
+    """
+    return tuple(map(lambda value: (True, 0) if value is None else (False, value), values))
+
+
 PROGRESS_LENGTH = 20
 
 
@@ -1,12 +1,14 @@
 
-from telegram.ext import CommandHandler, MessageHandler, Filters
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 
 from libs.filters.general_filters import filter_is_pm
 
 from resources.globals import updater, dispatcher, job_queue, engine, Base, SessionMaker
 
-from bin.api import update_all, TOPS_INTERVAL, view_players, view_ship, view_ships, spy, player_history, start, \
-    register, register_id, sub, sub_id
+from bin.api import update_all, maintain_history_partitions, TOPS_INTERVAL, view_players, view_ship, view_ships, spy, \
+    player_history, player_history_page, view_page, start, register, register_id, sub, sub_id
+from bin.consistency import check_consistency
+from bin.notifications import send_notifications, NOTIFICATIONS_INTERVAL
 
 from libs.models.Location import Location
 from libs.models.Guild import Guild
@@ -26,14 +28,20 @@ dispatcher.add_handler(MessageHandler(Filters.command & Filters.regex("/sub_\\d+
 dispatcher.add_handler(MessageHandler(Filters.command & Filters.regex("/sh[_ ].+"), view_ship))
 dispatcher.add_handler(CommandHandler('spy', spy))
 dispatcher.add_handler(MessageHandler(Filters.command & Filters.regex("/pl_history_\\d+.*"), player_history))
+dispatcher.add_handler(CallbackQueryHandler(player_history_page, pattern="plh_\\d+_\\d+_\\d+"))
+dispatcher.add_handler(CallbackQueryHandler(view_page, pattern="pg_"))
 
 job_queue.run_repeating(update_all, TOPS_INTERVAL * 60, first=5)
+job_queue.run_repeating(maintain_history_partitions, 24 * 60 * 60, first=60)
+job_queue.run_repeating(send_notifications, NOTIFICATIONS_INTERVAL, first=10)
+job_queue.run_repeating(check_consistency, 60 * 60, first=5 * 60)
 
 
 def init_database():
     Base.metadata.create_all(engine)
 
     session = SessionMaker()
+    maintain_history_partitions()
     Location.init_database(session)
     Guild.init_database(session)
     session.close()
@@ -1,23 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Iterable
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from libs.json_stream import iter_array_items
 
 import requests
 import logging
+import threading
+import traceback
+
+
+class NotModified(RuntimeError):
+    """
+    Сервер ответил 304 - данные не изменились с прошлого запроса, обрабатывать нечего
+    """
 
 
 class ExpeditionAPI:
     BASE_URL = "https://api.extracoffee.pro/public/v1/"
 
+    TIMEOUT = (3.05, 20)  # connect, read (seconds)
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+    POOL_SIZE = 4
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    _session: requests.Session = None
+    _session_lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="expedition_api")
+    _validators: Dict[str, Dict[str, str]] = {}  # endpoint -> ETag / Last-Modified последнего ответа
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """
+        Общая сессия с пулом соединений, повторами с backoff и запросом gzip
+        """
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    retry = Retry(total=cls.RETRIES, backoff_factor=cls.BACKOFF_FACTOR,
+                                  status_forcelist=(500, 502, 503, 504))
+                    adapter = HTTPAdapter(pool_connections=cls.POOL_SIZE, pool_maxsize=cls.POOL_SIZE,
+                                          max_retries=retry)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({"Accept-Encoding": "gzip"})
+                    cls._session = session
+        return cls._session
+
+    @classmethod
+    def reset_validators(cls, endpoint: str = None):
+        """
+        Забыть ETag / Last-Modified, чтобы следующий запрос вернул данные целиком (например, если тик не записался)
+        """
+        if endpoint is None:
+            cls._validators.clear()
+        else:
+            cls._validators.pop(endpoint, None)
+
     @classmethod
-    def get_users(cls):
-        result = requests.get(cls.BASE_URL + "users")
+    def request(cls, endpoint: str, stream: bool = False):
+        """
+        :param stream: Не загружать ответ целиком, а вернуть итератор по элементам массива ответа[endpoint]
+        """
+        headers = {}
+        validators = cls._validators.get(endpoint, {})
+        if "ETag" in validators:
+            headers.update({"If-None-Match": validators.get("ETag")})
+        if "Last-Modified" in validators:
+            headers.update({"If-Modified-Since": validators.get("Last-Modified")})
+        try:
+            result = cls.get_session().get(cls.BASE_URL + endpoint, headers=headers, timeout=cls.TIMEOUT,
+                                           stream=stream)
+        except requests.RequestException:
+            logging.error("Error in GET /{}: {}".format(endpoint, traceback.format_exc()))
+            raise RuntimeError
+        if result.status_code == 304:
+            result.close()
+            logging.info("GET /{}: not modified".format(endpoint))
+            raise NotModified
         if result.status_code // 100 != 2:
-            logging.error("Error in GET /users: {}".format(result.text))
+            logging.error("Error in GET /{}: {}".format(endpoint, result.text))
             raise RuntimeError
+        cls._validators.update({endpoint: {
+            key: result.headers.get(key) for key in ("ETag", "Last-Modified") if result.headers.get(key)}})
+        if stream:
+            return cls._stream_items(result, endpoint)
         return result.json()
 
+    @classmethod
+    def _stream_items(cls, result: requests.Response, key: str):
+        if result.encoding is None:
+            result.encoding = "utf-8"
+        try:
+            yield from iter_array_items(result.iter_content(cls.STREAM_CHUNK_SIZE, decode_unicode=True), key)
+        finally:
+            result.close()
+
+    @classmethod
+    def get_users(cls, stream: bool = False):
+        return cls.request("users", stream=stream)
+
     @classmethod
     def get_ships(cls):
-        result = requests.get(cls.BASE_URL + "ships")
-        if result.status_code // 100 != 2:
-            logging.error("Error in GET /ships: {}".format(result.text))
-            raise RuntimeError
-        return result.json()
+        return cls.request("ships")
+
+    @classmethod
+    def fetch_all(cls, *endpoints: str, streams: Iterable[str] = ()) -> Dict[str, Future]:
+        """
+        Запрашивает endpoints параллельно, время ожидания равно времени самого медленного запроса
+        :param streams: Endpoints, ответ которых нужно разбирать потоково (см. request)
+        :return: {endpoint: Future}, Future.result() возвращает ответ или бросает RuntimeError / NotModified
+        """
+        return {endpoint: cls._executor.submit(cls.request, endpoint, endpoint in streams) for endpoint in endpoints}
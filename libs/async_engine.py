@@ -0,0 +1,173 @@
+from telegram import Message
+
+from libs.rate_limiter import RateLimiter
+from libs.scheduler import backoff, NETWORK_RETRIES, NETWORK_BACKOFF_BASE, NETWORK_BACKOFF_MAX
+
+from typing import Callable, Dict, Optional
+
+import sys
+import asyncio
+import itertools
+import json
+import logging
+import threading
+import traceback
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncSendEngine:
+    """
+    Отправка sendMessage / editMessageText из одного потока с циклом asyncio и пулом соединений aiohttp
+    вместо пула потоков AsyncBot. Лимиты те же (общий RateLimiter): сообщение, которому рано отправляться,
+    откладывается таймером цикла и не занимает ни поток, ни корутину.
+    Необязательная зависимость: без aiohttp available() == False и AsyncBot работает через потоки.
+    Политика чатов (спам-чаты, очередь ожидания групп) и повторы при сетевых ошибках - те же, что у потоков AsyncBot
+    """
+    MAX_CONCURRENT_REQUESTS = 32
+    TIMEOUT = 20  # seconds
+    API_FIELDS = {"chat_id", "message_id", "text", "parse_mode", "disable_web_page_preview", "disable_notification",
+                  "reply_to_message_id", "reply_markup"}
+
+    def __init__(self, bot, rate_limiter: RateLimiter, proxy_url: str = None,
+                 admit: Callable[[str, Dict], Optional[float]] = None):
+        """
+        :param admit: admit(method, kwargs) - 0, если можно отправлять; задержка до повтора; None, если сообщение
+            забрала очередь ожидания AsyncBot. По умолчанию - только лимиты rate_limiter
+        """
+        self.bot = bot
+        self.rate_limiter = rate_limiter
+        self.admit = admit or (lambda method, kwargs: rate_limiter.acquire(kwargs.get("chat_id", 0)))
+        if proxy_url is not None and not proxy_url.startswith("http"):
+            logging.warning("aiohttp supports only HTTP proxies, {} is ignored by async send engine".format(proxy_url))
+            proxy_url = None
+        self.proxy_url = proxy_url
+        # Цикл создаётся сразу: вызовы submit до start() копятся в нём и выполняются после запуска
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.session = None
+        self.thread: Optional[threading.Thread] = None
+        self.started = threading.Event()
+        self._counter = itertools.count()
+
+    @staticmethod
+    def available() -> bool:
+        return aiohttp is not None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="async_send_engine", daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        """
+        Сигнал остановки встаёт после всех сообщений в очереди - они успевают уйти
+        """
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self._put_stop)
+            self.thread.join()
+
+    def submit(self, method: str, kwargs: Dict, priority: int, on_complete: Callable = None):
+        """
+        Потокобезопасно ставит вызов в очередь цикла
+        :param method: Метод Bot API (sendMessage, editMessageText)
+        :param on_complete: Вызывается с результатом (telegram.Message) после успешной отправки
+        """
+        item = {"method": method, "kwargs": kwargs, "data": self.prepare_data(kwargs), "on_complete": on_complete,
+                "retry": 0}
+        self.loop.call_soon_threadsafe(self._put, item, priority)
+
+    @classmethod
+    def prepare_data(cls, kwargs: Dict) -> Dict:
+        data = {key: value for key, value in kwargs.items() if key in cls.API_FIELDS and value is not None}
+        if "reply_markup" in data:
+            data.update({"reply_markup": data.get("reply_markup").to_dict()})
+        return data
+
+    def _get_queue(self) -> asyncio.PriorityQueue:
+        # Очередь создаётся в потоке цикла: до Python 3.10 она привязывается к текущему циклу при создании
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        return self.queue
+
+    def _put(self, item: Dict, priority: int):
+        item.update({"priority": priority})
+        self._get_queue().put_nowait((priority, next(self._counter), item))
+
+    def _put_stop(self):
+        self._get_queue().put_nowait((sys.maxsize, next(self._counter), None))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        queue = self._get_queue()
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_REQUESTS)
+        connector = aiohttp.TCPConnector(limit=self.MAX_CONCURRENT_REQUESTS)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=self.TIMEOUT)) as self.session:
+            self.started.set()
+            while True:
+                priority, _, item = await queue.get()
+                if item is None:
+                    break
+                delay = self.admit(item.get("method"), item.get("kwargs"))
+                if delay is None:
+                    # Спам-чат или группа на лимите: сообщение отправит очередь ожидания AsyncBot
+                    continue
+                if delay > 0:
+                    # Слот освободится через delay - возвращаем сообщение в очередь по таймеру
+                    self.loop.call_later(delay, self._put, item, priority)
+                    continue
+                await semaphore.acquire()
+                self.loop.create_task(self._send(item, semaphore))
+            # Дожидаемся запросов, которые ещё в полёте, до закрытия сессии
+            for _ in range(self.MAX_CONCURRENT_REQUESTS):
+                await semaphore.acquire()
+
+    async def _send(self, item: Dict, semaphore: asyncio.Semaphore):
+        try:
+            async with self.session.post("{}/{}".format(self.bot.base_url, item.get("method")),
+                                         json=item.get("data"), proxy=self.proxy_url) as response:
+                result = json.loads(await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if item.get("retry") < NETWORK_RETRIES:
+                delay = backoff(item.get("retry"), NETWORK_BACKOFF_BASE, NETWORK_BACKOFF_MAX)
+                item.update({"retry": item.get("retry") + 1})
+                self.loop.call_later(delay, self._put, item, item.get("priority"))
+            else:
+                logging.error("Can not send {}: {}".format(item.get("method"), traceback.format_exc()))
+            return
+        except Exception:
+            logging.error("Unknown exception in async send engine! {}".format(traceback.format_exc()))
+            return
+        finally:
+            semaphore.release()
+        self._handle_result(item, result)
+
+    def _handle_result(self, item: Dict, result: Dict):
+        if result.get("ok"):
+            on_complete = item.get("on_complete")
+            if on_complete is not None and isinstance(result.get("result"), dict):
+                on_complete(Message.de_json(result.get("result"), self.bot))
+            return
+        error_code, description = result.get("error_code"), result.get("description", "")
+        if error_code == 429:
+            retry_after = (result.get("parameters") or {}).get("retry_after", 1)
+            self.rate_limiter.report_retry_after(item.get("data").get("chat_id", 0), retry_after)
+            self.loop.call_later(retry_after, self._put, item, item.get("priority"))
+        elif error_code == 400 and "can't parse entities" in description.lower() and \
+                "parse_mode" in item.get("data"):
+            logging.error("Resending without parse mode...")
+            item.get("data").pop("parse_mode")
+            item.get("kwargs").pop("parse_mode", None)
+            self._put(item, item.get("priority"))
+        elif error_code != 403:
+            logging.error("Can not send {}: {} {}".format(item.get("method"), error_code, description))
@@ -3,8 +3,9 @@ from telegram.utils.request import Request
 from telegram.error import (TelegramError, Unauthorized, BadRequest,
                             TimedOut, ChatMigrated, NetworkError, RetryAfter)
 
+from typing import Dict, Optional
 
-import multiprocessing
+import itertools
 import queue
 import threading
 import time
@@ -14,34 +15,44 @@ import re
 import sys
 import requests
 
+from libs.rate_limiter import RateLimiter
+from libs.async_engine import AsyncSendEngine
+from libs.coalescer import MessageCoalescer
+from libs.scheduler import DelayedDelivery, backoff, NETWORK_RETRIES, NETWORK_BACKOFF_BASE, NETWORK_BACKOFF_MAX
+
 MESSAGE_PER_SECOND_LIMIT = 29
 MESSAGE_PER_CHAT_LIMIT = 3
 MESSAGE_PER_CHAT_MINUTE_LIMIT = 19
+GLOBAL_WAIT = 1 / MESSAGE_PER_SECOND_LIMIT  # Дольше ждать может только чат, упёршийся в свои лимиты
 
 UNAUTHORIZED_ERROR_CODE = 2
 BADREQUEST_ERROR_CODE = 3
 
 MAX_MESSAGE_LENGTH = 4096
 
+COALESCE_WINDOW = 1  # seconds, сколько ждать других сообщений в тот же чат (send_message(..., coalesce=True))
+
+# Приоритеты очереди отправки (меньше - раньше): ответы на команды, табло гильдий, массовые уведомления
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BOARD = 1
+PRIORITY_BULK = 2
+PRIORITY_STOP = 100  # Сигнал остановки воркеров (None) - после всех сообщений, уже стоящих в очереди
+
 
 class AsyncBot(Bot):
 
-    def __init__(self, token, workers=4, request_kwargs=None):
-        counter_rlock = threading.RLock()
-        self.counter_lock = threading.Condition(counter_rlock)
-        self.message_queue = multiprocessing.Queue()
-        self.waiting_chats_message_queue = multiprocessing.Queue()
+    def __init__(self, token, workers=4, request_kwargs=None, async_engine=False):
+        """
+        :param async_engine: Отправлять sendMessage и editMessageTextRestricted через AsyncSendEngine (нужен aiohttp)
+        """
+        self.rate_limiter = RateLimiter(MESSAGE_PER_SECOND_LIMIT, MESSAGE_PER_CHAT_LIMIT, MESSAGE_PER_CHAT_MINUTE_LIMIT)
+        self.message_queue = PriorityMessageQueue()
+        self.waiting_chats_message_queue = PriorityMessageQueue()
         self.dispatcher = None
         self.processing = True
         self.num_workers = workers
-        self.messages_per_second = 0
-        self.messages_per_chat = {}
-        self.messages_per_chat_per_minute = {}
         self.spam_chats_count = {}
 
-        self.second_reset_queue = multiprocessing.Queue()
-        self.minute_reset_queue = multiprocessing.Queue()
-
         self.workers = []
         self.resending_workers = []
         self.group_workers = []
@@ -53,6 +64,17 @@ class AsyncBot(Bot):
         self._request = Request(**request_kwargs)
         super(AsyncBot, self).__init__(token=token, request=self._request)
 
+        self.delayed_delivery = DelayedDelivery()
+        self.coalescer = MessageCoalescer(COALESCE_WINDOW, MAX_MESSAGE_LENGTH, self._enqueue_message)
+
+        self.engine = None
+        if async_engine:
+            if AsyncSendEngine.available():
+                self.engine = AsyncSendEngine(self, self.rate_limiter, request_kwargs.get("proxy_url"),
+                                              admit=self._admit_engine)
+            else:
+                logging.warning("aiohttp is not installed, async send engine is disabled")
+
         self.types_to_methods = {0: self.send_message, 1: self.send_video, 2: self.send_audio, 3: self.send_photo,
                                  4: self.send_document, 5: self.send_sticker, 6: self.send_voice, 7: self.sendVideoNote}
         self.methods_ty_types = {v: k for k, v in list(self.types_to_methods.items())}
@@ -70,6 +92,19 @@ class AsyncBot(Bot):
     #     return "https://api.telegram.org/bot{}/".format(self.token)
 
     def send_message(self, *args, **kwargs):
+        """
+        :param coalesce: Можно объединить с другими текстовыми сообщениями в этот чат за COALESCE_WINDOW
+        """
+        if self.coalescer.accepts(args, kwargs):
+            self.coalescer.add(kwargs)
+            return 0
+        return self._enqueue_message(*args, **kwargs)
+
+    def _enqueue_message(self, *args, **kwargs):
+        if self.engine is not None and not args:
+            self.engine.submit("sendMessage", kwargs, kwargs.get("priority", PRIORITY_INTERACTIVE),
+                               on_complete=lambda sent: self._on_method_complete(0, sent, **kwargs))
+            return 0
         message = MessageInQueue(*args, **kwargs)
         self.message_queue.put(message)
         return 0
@@ -139,6 +174,12 @@ class AsyncBot(Bot):
 
     def editMessageTextRestricted(self, *args, **kwargs):
         kwargs.update({"message_type": -1})
+        kwargs.setdefault("priority", PRIORITY_BOARD)
+        if self.engine is not None and not args:
+            kwargs.pop("message_type")
+            self.engine.submit("editMessageText", kwargs, kwargs.get("priority"),
+                               on_complete=lambda edited: self._on_method_complete(-1, edited, **kwargs))
+            return 0
         message = MessageInQueue(*args, **kwargs)
         self.message_queue.put(message)
         return 0
@@ -160,60 +201,13 @@ class AsyncBot(Bot):
         if message_type is None:
             message_type = 0
 
-        lock = self.counter_lock
-        lock.acquire()
-        try:
-            while True:
-                lock.acquire()
-                if chat_id in self.spam_chats_count and not kwargs.get("resending"):
-                    spam_was = self.spam_chats_count.get(chat_id)
-                    if time.time() - spam_was > 30 * 60:
-                        self.spam_chats_count.pop(chat_id)
-                    else:
-                        self.spam_chats_count.update({chat_id: time.time()})
-                        self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
-                        lock.release()
-                        return None
-                messages_per_current_chat = self.messages_per_chat.get(chat_id)
-                messages_per_current_chat_per_minute = self.messages_per_chat_per_minute.get(chat_id)
-                if messages_per_current_chat is None:
-                    messages_per_current_chat = 0
-                if messages_per_current_chat_per_minute is None:
-                    messages_per_current_chat_per_minute = 0
-                if self.messages_per_second < MESSAGE_PER_SECOND_LIMIT and messages_per_current_chat < \
-                        MESSAGE_PER_CHAT_LIMIT and messages_per_current_chat_per_minute < MESSAGE_PER_CHAT_MINUTE_LIMIT:
-                    self.messages_per_second += 1
-                    self.messages_per_chat.update({chat_id: messages_per_current_chat + 1})
-                    self.messages_per_chat_per_minute.update({chat_id: messages_per_current_chat_per_minute + 1})
-                    lock.release()
-                    break
-                else:
-                    if self.messages_per_second < MESSAGE_PER_SECOND_LIMIT and \
-                            (not kwargs.get("resending") or chat_id > 0):
-                        # Сообщения в эту секунду ещё можно отправлять
-                        if chat_id > 0:
-                            # Личка, маленькие чаты -- отправляем любое число сообщений в минуту
-                            if messages_per_current_chat < MESSAGE_PER_CHAT_LIMIT:
-                                self.messages_per_second += 1
-                                self.messages_per_chat.update({chat_id: messages_per_current_chat + 1})
-                                self.messages_per_chat_per_minute.update(
-                                    {chat_id: messages_per_current_chat_per_minute + 1})
-                                lock.release()
-                                break
-                        if messages_per_current_chat_per_minute >= MESSAGE_PER_CHAT_MINUTE_LIMIT:
-                            self.spam_chats_count.update({chat_id: time.time()})
-                        if not kwargs.get("message_in_group"):
-                            # Кладём в другую очередь, если сообщение не в группе сообщений
-                            self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
-                            lock.release()
-                            return None
-                lock.release()
-                lock.wait()
-        finally:
-            try:
-                lock.release()
-            except RuntimeError:
-                pass
+        delay = self._admit(chat_id, *args, **kwargs)
+        if delay is None:
+            return None
+        if delay > 0:
+            # Воркер не ждёт: сообщение вернётся в свою очередь, когда освободится слот
+            self._retry_later(delay, *args, **kwargs)
+            return None
         message = None
         try:
             try:
@@ -236,48 +230,73 @@ class AsyncBot(Bot):
                 kwargs.update({"forbid_entities": True})
                 return self.actually_send_message(*args, **kwargs)
             return BADREQUEST_ERROR_CODE
+        except RetryAfter as error:
+            # Чат (или весь бот) ждёт столько, сколько сказал Telegram, остальные чаты отправляются дальше
+            self.rate_limiter.report_retry_after(chat_id, error.retry_after)
+            self._retry_later(error.retry_after, *args, **kwargs)
+            return
         except (TimedOut, NetworkError):
             logging.error(traceback.format_exc())
-            # return None
-
-            # Временно отключена повторная попытка отправить -- уже нет
-            # Сообщение отправляется ещё раз, иначе -- отправляется в другую очередь
             retry = kwargs.get('retry')
             if retry is None:
                 retry = 0
-            if retry >= 1:
-                # Кладём в другую очередь
-                self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
+            if retry >= NETWORK_RETRIES:
+                logging.error("Giving up sending to {} after {} retries".format(chat_id, retry))
                 return
-            retry += 1
-            kwargs.update({"retry": retry})
-            time.sleep(0.1)
-            try:
-                method = self.types_to_original_methods.get(message_type)
-                if method is None:
-                    method = super(AsyncBot, self).send_message
-            except Exception:
-                logging.error(traceback.format_exc())
-                method = super(AsyncBot, self).send_message
-            message = method(*args, **kwargs)
-        except RetryAfter:
-            time.sleep(1)
-            self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
+            kwargs.update({"retry": retry + 1})
+            self._retry_later(backoff(retry, NETWORK_BACKOFF_BASE, NETWORK_BACKOFF_MAX), *args, **kwargs)
             return
         except Exception:
             logging.error("Unknown exception in bot worker! {}".format(traceback.format_exc()))
-        finally:
-            body = {"chat_id": chat_id, "time": time.time()}
-            self.second_reset_queue.put(body)
-            self.minute_reset_queue.put(body)
         return message
 
+    def _admit(self, chat_id: int, *args, **kwargs) -> Optional[float]:
+        """
+        Политика чатов, общая для воркеров и AsyncSendEngine: спам-чаты и группы, упёршиеся в лимиты,
+        уходят в очередь ожидания (её разбирают resending-воркеры), остальные занимают слот RateLimiter
+        :return: 0 - можно отправлять; > 0 - повторить через столько секунд; None - передано в очередь ожидания
+        """
+        if chat_id in self.spam_chats_count and not kwargs.get("resending"):
+            spam_was = self.spam_chats_count.get(chat_id)
+            if time.time() - spam_was > 30 * 60:
+                self.spam_chats_count.pop(chat_id, None)
+            else:
+                self.spam_chats_count.update({chat_id: time.time()})
+                self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
+                return None
+        delay = self.rate_limiter.acquire(chat_id)
+        if delay > 0:
+            if self.rate_limiter.is_minute_limited(chat_id):
+                # Группа упёрлась в лимит сообщений в минуту
+                self.spam_chats_count.update({chat_id: time.time()})
+            if RateLimiter.is_group(chat_id) and delay > GLOBAL_WAIT and not kwargs.get("resending") and \
+                    not kwargs.get("message_in_group"):
+                # Кладём в другую очередь, если сообщение не в группе сообщений
+                self.waiting_chats_message_queue.put(MessageInQueue(*args, **kwargs))
+                return None
+        return delay
+
+    def _admit_engine(self, method: str, kwargs: Dict) -> Optional[float]:
+        """
+        _admit для AsyncSendEngine: сообщение из очереди ожидания отправит resending-воркер, ему нужен тип сообщения
+        """
+        if method == "editMessageText":
+            kwargs = dict(kwargs, message_type=-1)
+        return self._admit(kwargs.get("chat_id", 0), **kwargs)
+
+    def _retry_later(self, delay: float, *args, **kwargs):
+        """
+        Возвращает сообщение в ту же очередь через delay секунд (DelayedDelivery), не занимая воркер
+        """
+        target_queue = self.waiting_chats_message_queue if kwargs.get("resending") else self.message_queue
+        self.delayed_delivery.schedule(delay, target_queue, MessageInQueue(*args, **kwargs))
+
     def _on_method_complete(self, message_type: int, message, *args, **kwargs):
         """
         Метод, который вызовется после выполнения метода апи бота
         """
-        if message_type == 0:
-            # Сообщение было отправлено
+        if message_type in {0, -1}:
+            # Сообщение было отправлено или изменено
             on_sent = kwargs.get("on_sent")
             if on_sent is not None:
                 # Нужно выполнить функцию после отправки сообщения, запускаю в отдельном потоке
@@ -293,17 +312,21 @@ class AsyncBot(Bot):
             self.workers.append(worker)
             resending_worker = threading.Thread(target=self.__resend_work, args=())
             resending_worker.start()
-            self.resending_workers.append(worker)
-        threading.Thread(target=self.__release_monitor, args=(self.second_reset_queue, 1)).start()
-        threading.Thread(target=self.__release_monitor, args=(self.minute_reset_queue, 60)).start()
+            self.resending_workers.append(resending_worker)
+        self.delayed_delivery.start()
+        self.coalescer.start()
+        if self.engine is not None:
+            self.engine.start()
 
     def set_dispatcher(self, dispatcher):
         self.dispatcher = dispatcher
 
     def stop(self):
-        self.processing = False
-        self.second_reset_queue.put(None)
-        self.minute_reset_queue.put(None)
+        # Сообщения, ожидающие объединения, ставятся в очереди до сигнала остановки и отправляются воркерами.
+        # Отложенные из-за лимитов и RetryAfter (DelayedDelivery) при остановке теряются
+        self.coalescer.stop()
+        if self.engine is not None:
+            self.engine.stop()
         for i in range(0, self.num_workers):
             self.message_queue.put(None)
             self.waiting_chats_message_queue.put(None)
@@ -311,6 +334,8 @@ class AsyncBot(Bot):
             i.join()
         for i in self.resending_workers:
             i.join()
+        self.processing = False
+        self.delayed_delivery.stop()
         time.sleep(1)
         try:
             while True:
@@ -322,77 +347,18 @@ class AsyncBot(Bot):
                 self.waiting_chats_message_queue.get_nowait()
         except queue.Empty:
             pass
-        self.message_queue.close()
-        self.waiting_chats_message_queue.close()
-        self.second_reset_queue.close()
-        self.minute_reset_queue.close()
 
     def __del__(self):
         self.processing = False
         for i in range(0, self.num_workers):
             #self.message_queue.put(None)
             pass
-        self.message_queue.close()
         try:
             super(AsyncBot, self).__del__()
         except AttributeError:
             pass
 
 
-    def __releasing_resourse(self, chat_id):
-        with self.counter_lock:
-            self.messages_per_second -= 1
-            mes_per_chat = self.messages_per_chat.get(chat_id)
-            if mes_per_chat is None:
-                self.counter_lock.notify_all()
-                return
-            if mes_per_chat == 1:
-                self.messages_per_chat.pop(chat_id)
-                self.counter_lock.notify_all()
-                return
-            mes_per_chat -= 1
-            self.messages_per_chat.update({chat_id: mes_per_chat})
-            self.counter_lock.notify_all()
-
-    def __release_monitor(self, release_queue, interval):
-        data = release_queue.get()
-        while self.processing and data is not None:
-            chat_id = data.get("chat_id")
-            set_time = data.get("time")
-            if chat_id is None or time is None:
-                data = release_queue.get()
-                continue
-            remaining_time = interval - (time.time() - set_time)
-            if remaining_time > 0:
-                while remaining_time > 5:
-                    time.sleep(5)
-                    remaining_time -= 5
-                    if not self.processing:
-                        return
-                time.sleep(remaining_time)
-            if interval == 60:
-                self.__releasing_minute_resourse(chat_id)
-            else:
-                self.__releasing_resourse(chat_id)
-            try:
-                data = release_queue.get()
-            except Exception:
-                return
-
-    def __releasing_minute_resourse(self, chat_id):
-        with self.counter_lock:
-            mes_per_chat = self.messages_per_chat_per_minute.get(chat_id)
-            if mes_per_chat is None:
-                self.counter_lock.notify_all()
-                return
-            if mes_per_chat == 1:
-                self.messages_per_chat_per_minute.pop(chat_id)
-                self.counter_lock.notify_all()
-                return
-            mes_per_chat -= 1
-            self.messages_per_chat_per_minute.update({chat_id: mes_per_chat})
-            self.counter_lock.notify_all()
-
     def __work(self):
         message_in_queue = self.message_queue.get()
         while self.processing and message_in_queue is not None:
@@ -413,9 +379,7 @@ class AsyncBot(Bot):
             args = message_in_queue.args
             kwargs = message_in_queue.kwargs
             kwargs.update({"resending": True})
-            mes = self.actually_send_message(*args, **kwargs)
-            if mes is None:
-                time.sleep(0.1)
+            self.actually_send_message(*args, **kwargs)
             message_in_queue = self.waiting_chats_message_queue.get()
             if message_in_queue is None:
                 return 0
@@ -423,7 +387,40 @@ class AsyncBot(Bot):
 
 
 class MessageInQueue:
+    """
+    Приоритет передаётся в kwargs (priority=PRIORITY_...) и сохраняется при повторной постановке в очередь
+    """
 
     def __init__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
+
+    @property
+    def priority(self) -> int:
+        return self.kwargs.get("priority", PRIORITY_INTERACTIVE)
+
+
+class PriorityMessageQueue:
+    """
+    Очередь сообщений в памяти процесса: все производители и воркеры - потоки одного процесса,
+    поэтому сообщения не сериализуются и не проходят через pipe, как в multiprocessing.Queue.
+    Меньший приоритет отправляется раньше, при равном - в порядке постановки
+    """
+
+    def __init__(self):
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+
+    def put(self, message: MessageInQueue, priority: int = None):
+        if priority is None:
+            priority = message.priority if message is not None else PRIORITY_STOP
+        self._queue.put((priority, next(self._counter), message))
+
+    def get(self, block: bool = True, timeout: float = None) -> MessageInQueue:
+        return self._queue.get(block, timeout)[2]
+
+    def get_nowait(self) -> MessageInQueue:
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
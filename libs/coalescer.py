@@ -0,0 +1,118 @@
+from typing import Callable, Dict, List, Tuple
+
+import heapq
+import threading
+import time
+
+
+def call_all(message, callbacks: List[Tuple[Callable, list, dict]]):
+    """
+    on_sent объединённого сообщения: вызывает on_sent всех исходных сообщений
+    """
+    for on_sent, args, kwargs in callbacks:
+        on_sent(message, *args, **kwargs)
+
+
+class MessageCoalescer:
+    """
+    Объединяет простые текстовые сообщения в один чат с одинаковым parse_mode, пришедшие в течение window секунд,
+    в как можно меньшее число сообщений не длиннее max_length. Экономит лимиты Telegram на чат и запросы к API.
+    Сообщения участвуют, только если отправлены с coalesce=True и без клавиатур и прочих параметров
+    """
+    SEPARATOR = "\n\n"
+    FIELDS = {"chat_id", "text", "parse_mode", "coalesce", "priority", "on_sent", "on_sent_args", "on_sent_kwargs"}
+
+    def __init__(self, window: float, max_length: int, flush: Callable[..., None]):
+        """
+        :param flush: Отправка объединённого сообщения, вызывается с kwargs send_message
+        """
+        self.window = window
+        self.max_length = max_length
+        self.flush = flush
+        self.pending: Dict[tuple, List[dict]] = {}  # (chat_id, parse_mode) -> kwargs сообщений
+        self.deadlines: List[Tuple[float, tuple]] = []  # куча (время отправки, ключ)
+        self.condition = threading.Condition()
+        self.processing = True
+        self.thread = None
+
+    def accepts(self, args: tuple, kwargs: dict) -> bool:
+        return not args and bool(kwargs.get("coalesce")) and kwargs.get("chat_id") is not None and \
+            isinstance(kwargs.get("text"), str) and set(kwargs) <= self.FIELDS
+
+    def add(self, kwargs: dict):
+        key = (kwargs.get("chat_id"), kwargs.get("parse_mode"))
+        with self.condition:
+            if key not in self.pending:
+                self.pending.update({key: []})
+                heapq.heappush(self.deadlines, (time.monotonic() + self.window, key))
+                self.condition.notify()
+            self.pending.get(key).append(kwargs)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__work, name="message_coalescer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.processing = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        for messages in self.pending.values():
+            self.__flush_messages(messages)
+        self.pending.clear()
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.processing and (not self.deadlines or self.deadlines[0][0] > time.monotonic()):
+                    self.condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                if not self.processing:
+                    return
+                _, key = heapq.heappop(self.deadlines)
+                messages = self.pending.pop(key)
+            self.__flush_messages(messages)
+
+    def __flush_messages(self, messages: List[dict]):
+        for batch in self.merge(messages):
+            self.flush(**batch)
+
+    def merge(self, messages: List[dict]) -> List[dict]:
+        """
+        Склеивает тексты по порядку, пока объединённый текст не длиннее max_length
+        """
+        if len(messages) == 1:
+            return [self.strip(messages[0])]
+        batches, current = [], []
+        for message in messages:
+            if current and len(self.SEPARATOR.join(map(lambda item: item.get("text"), current + [message]))) > \
+                    self.max_length:
+                batches.append(current)
+                current = []
+            current.append(message)
+        if current:
+            batches.append(current)
+        return list(map(self.combine, batches))
+
+    def combine(self, messages: List[dict]) -> dict:
+        if len(messages) == 1:
+            return self.strip(messages[0])
+        first = messages[0]
+        kwargs = {"chat_id": first.get("chat_id"), "text": self.SEPARATOR.join(map(lambda item: item.get("text"),
+                                                                                    messages))}
+        if first.get("parse_mode") is not None:
+            kwargs.update({"parse_mode": first.get("parse_mode")})
+        priorities = list(filter(lambda priority: priority is not None,
+                                 map(lambda item: item.get("priority"), messages)))
+        if priorities:
+            kwargs.update({"priority": min(priorities)})
+        callbacks = list(map(lambda item: (item.get("on_sent"), item.get("on_sent_args", []),
+                                           item.get("on_sent_kwargs") or {}),
+                             filter(lambda item: item.get("on_sent") is not None, messages)))
+        if callbacks:
+            kwargs.update({"on_sent": call_all, "on_sent_args": [callbacks]})
+        return kwargs
+
+    @staticmethod
+    def strip(kwargs: dict) -> dict:
+        return {key: value for key, value in kwargs.items() if key != "coalesce"}
@@ -0,0 +1,93 @@
+from typing import Dict, Iterable, Optional
+
+import datetime
+
+import numpy as np
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(date: datetime.datetime) -> float:
+    return (date - EPOCH).total_seconds()
+
+
+def from_seconds(seconds: float) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(seconds=float(seconds))
+
+
+class ProgressSamples:
+    """
+    Последние замеры (время, прогресс %) летящих кораблей: по кораблю кольцевой буфер numpy на MAX_SAMPLES замеров.
+    Время прибытия всех кораблей считается раз в тик одной пакетной линейной регрессией (estimate)
+    и не зависит от того, было ли замечено отправление
+    """
+    MAX_SAMPLES = 32
+    MIN_SAMPLES = 2
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.samples: Dict[int, np.ndarray] = {}  # ship.id -> [[seconds, progress], ...], пустые ячейки - nan
+        self.counts: Dict[int, int] = {}  # ship.id -> число записанных замеров
+        self.last_progress: Dict[int, float] = {}
+
+    def add(self, ship_id: int, date: datetime.datetime, progress: float, departed_date: datetime.datetime = None):
+        """
+        :param departed_date: Если известно, новый полёт начинается с замера (departed_date, 0%)
+        """
+        if progress < self.last_progress.get(ship_id, 0):
+            # Прогресс уменьшился - это уже следующий полёт
+            self.discard(ship_id)
+        if ship_id not in self.samples:
+            self.samples.update({ship_id: np.full((self.max_samples, 2), np.nan)})
+            self.counts.update({ship_id: 0})
+            if departed_date is not None and departed_date < date:
+                self._write(ship_id, departed_date, 0.0)
+        self._write(ship_id, date, progress)
+        self.last_progress.update({ship_id: progress})
+
+    def _write(self, ship_id: int, date: datetime.datetime, progress: float):
+        count = self.counts.get(ship_id)
+        self.samples.get(ship_id)[count % self.max_samples] = (to_seconds(date), progress)
+        self.counts.update({ship_id: count + 1})
+
+    def discard(self, ship_id: int):
+        self.samples.pop(ship_id, None)
+        self.counts.pop(ship_id, None)
+        self.last_progress.pop(ship_id, None)
+
+    def prune(self, underway_ids: Iterable[int]):
+        """
+        Удаляет замеры кораблей, которые больше не летят (прилетели, разбились, пропали из ответа API)
+        """
+        underway_ids = set(underway_ids)
+        for ship_id in [ship_id for ship_id in self.samples if ship_id not in underway_ids]:
+            self.discard(ship_id)
+
+    def estimate(self, now: datetime.datetime,
+                 ship_ids: Iterable[int] = None) -> Dict[int, Optional[datetime.datetime]]:
+        """
+        Прогноз прибытия (прогресс 100%) по МНК-прямой progress = a * t + b для всех кораблей сразу
+        :param ship_ids: Посчитать только для этих кораблей (по умолчанию - для всех)
+        :return: {ship.id: время прибытия или None, если замеров недостаточно или корабль не движется}
+        """
+        ship_ids = list(filter(lambda ship_id: ship_id in self.samples,
+                               self.samples.keys() if ship_ids is None else ship_ids))
+        if not ship_ids:
+            return {}
+        data = np.stack(list(map(self.samples.get, ship_ids)))  # (корабли, замеры, 2)
+        origin = to_seconds(now)  # Время отсчитывается от now, чтобы не терять точность в квадратах
+        mask = ~np.isnan(data[:, :, 0])
+        x = np.where(mask, data[:, :, 0] - origin, 0.0)
+        y = np.where(mask, data[:, :, 1], 0.0)
+        n = mask.sum(axis=1)
+        sx, sy = x.sum(axis=1), y.sum(axis=1)
+        sxx, sxy = (x * x).sum(axis=1), (x * y).sum(axis=1)
+        denominator = n * sxx - sx * sx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (n * sxy - sx * sy) / denominator
+            intercept = (sy - slope * sx) / n
+            arrival = (100 - intercept) / slope
+        valid = (n >= self.MIN_SAMPLES) & (denominator > 0) & (slope > 0) & np.isfinite(arrival)
+        return {ship_id: from_seconds(origin + seconds) if is_valid else None
+                for ship_id, seconds, is_valid in zip(ship_ids, arrival, valid)}
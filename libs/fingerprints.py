@@ -0,0 +1,43 @@
+from typing import Dict, Iterable, Iterator, Tuple
+
+
+class PayloadFingerprints:
+    """
+    Хранит компактный отпечаток (hash полей) каждой записи из прошлого тика API
+    и пропускает записи, которые с тех пор не изменились.
+    Отпечатки нового тика применяются только после commit(), чтобы при ошибке записи в базу тик повторился целиком.
+    """
+
+    def __init__(self, key: str, fields: Tuple[str, ...]):
+        self.key = key
+        self.fields = fields
+        self.fingerprints: Dict[str, int] = {}
+        self.pending: Dict[str, int] = {}
+        self.skipped = 0
+        self.processed = 0
+
+    def fingerprint(self, record: dict) -> int:
+        return hash(tuple(record.get(field) for field in self.fields))
+
+    def filter_changed(self, records: Iterable[dict]) -> Iterator[dict]:
+        """
+        Возвращает только новые или изменившиеся записи, считает пропущенные и обработанные
+        """
+        self.pending.clear()
+        self.skipped, self.processed = 0, 0
+        for record in records:
+            key, fingerprint = record.get(self.key), self.fingerprint(record)
+            if self.fingerprints.get(key) == fingerprint:
+                self.skipped += 1
+                continue
+            self.pending.update({key: fingerprint})
+            self.processed += 1
+            yield record
+
+    def commit(self):
+        self.fingerprints.update(self.pending)
+        self.pending.clear()
+
+    def reset(self):
+        self.fingerprints.clear()
+        self.pending.clear()
@@ -0,0 +1,63 @@
+from typing import Iterable, Iterator
+
+import json
+
+_decoder = json.JSONDecoder()
+_SEPARATORS = " \t\n\r,"
+_WHITESPACE = " \t\n\r"
+
+
+def _is_item_end(buffer: str, end: int) -> bool:
+    """
+    Число или литерал, обрезанный границей куска (например, "-1500." из "-1500.0"), raw_decode разбирает
+    частично. Элемент закончен, только если за ним (после пробелов) в буфере уже стоит "," или "]"
+    """
+    while end < len(buffer) and buffer[end] in _WHITESPACE:
+        end += 1
+    return end < len(buffer) and buffer[end] in ",]"
+
+
+def iter_array_items(chunks: Iterable[str], key: str) -> Iterator:
+    """
+    Потоково разбирает JSON вида {..., "key": [item, item, ...], ...} и возвращает элементы массива по одному.
+    В памяти одновременно находятся только текущий кусок ответа и один элемент.
+    :param chunks: Куски текста ответа (например, Response.iter_content(decode_unicode=True))
+    :param key: Ключ верхнего уровня, под которым лежит массив
+    """
+    chunks = iter(chunks)
+    marker = '"{}"'.format(key)
+    buffer = ""
+    # Поиск начала массива
+    while True:
+        index = buffer.find(marker)
+        start = buffer.find("[", index + len(marker)) if index != -1 else -1
+        if start != -1:
+            buffer = buffer[start + 1:]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Key {} not found in JSON".format(key))
+        buffer += chunk
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in _SEPARATORS:
+            position += 1
+        if position < len(buffer):
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                pass
+            else:
+                if isinstance(item, (dict, list)) or _is_item_end(buffer, end):
+                    position = end
+                    yield item
+                    continue
+        buffer = buffer[position:]
+        position = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("Unexpected end of JSON array {}".format(key))
+        buffer += chunk
@@ -2,13 +2,94 @@
 from sqlalchemy import Column, ForeignKey, INT, VARCHAR, BOOLEAN, TIMESTAMP
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import insert
+
+from collections import namedtuple, defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
 
 from first import first
 from fuzzywuzzy import fuzz
 
-from resources.globals import Base
+from resources.globals import Base, SessionMaker
 
+import re
+import bisect
 import logging
+import threading
+
+
+SPACE_NAME = "Space"
+
+# Локация в памяти процесса (не привязана к сессии, можно использовать из любого потока)
+LocationInfo = namedtuple("LocationInfo", ["id", "name", "is_space"])
+
+
+def normalize_name(name: str) -> str:
+    return re.sub("\\W+", "", name.lower())
+
+
+def name_ngrams(name: str) -> Set[str]:
+    """
+    Первая буква и биграммы нормализованного имени - ключи индекса для нечёткого поиска по коду
+    """
+    return {name[:1]} | {name[i:i + 2] for i in range(len(name) - 1)}
+
+
+def code_confidence(code: str, name: str) -> int:
+    """
+    Уверенность (0-100) в том, что код корабельного маршрута (MRS) обозначает локацию (mars).
+    Половина - похожесть строк, половина - насколько код является подпоследовательностью букв имени.
+    """
+    matched, position = 0, 0
+    for char in code:
+        position = name.find(char, position) + 1
+        if position == 0:
+            break
+        matched += 1
+    return int(fuzz.ratio(code, name) / 2 + 50 * matched / max(len(code), 1))
+
+
+class LocationRegistry:
+    """
+    Неизменяемый набор всех локаций: name -> id, id -> name и поиск по началу названия.
+    При появлении новой локации создаётся новый реестр и подменяется целиком.
+    """
+
+    def __init__(self, locations: Iterable[LocationInfo]):
+        self.by_id: Dict[int, LocationInfo] = {location.id: location for location in locations}
+        self.by_name: Dict[str, LocationInfo] = {location.name: location for location in self.by_id.values()}
+        self.prefixes = sorted(map(lambda location: (location.name.lower(), location.id), self.by_id.values()))
+        space_location = first(self.by_id.values(), key=lambda location: location.is_space)
+        self.space_id: Optional[int] = space_location.id if space_location else None
+        self.ngrams: Dict[str, Set[str]] = defaultdict(set)
+        for location in filter(lambda location: not location.is_space, self.by_id.values()):
+            normalized = normalize_name(location.name)
+            for ngram in name_ngrams(normalized):
+                self.ngrams[ngram].add(location.name)
+        self.normalized = {location.name: normalize_name(location.name) for location in self.by_id.values()}
+
+    def guess_code(self, code: str) -> Tuple[Optional[str], int]:
+        """
+        Наиболее вероятная локация для неизвестного кода, сравниваются только кандидаты из индекса
+        :return: (name, confidence) или (None, 0), если кандидатов нет
+        """
+        code = normalize_name(code)
+        candidates = set()
+        for ngram in name_ngrams(code):
+            candidates |= self.ngrams.get(ngram, set())
+        best_name, best_confidence = None, 0
+        for name in sorted(candidates):
+            confidence = code_confidence(code, self.normalized.get(name))
+            if confidence > best_confidence:
+                best_name, best_confidence = name, confidence
+        return best_name, best_confidence
+
+    def search(self, prefix: str) -> Optional[LocationInfo]:
+        prefix = prefix.lower()
+        index = bisect.bisect_left(self.prefixes, (prefix, ))
+        if index < len(self.prefixes) and self.prefixes[index][0].startswith(prefix):
+            return self.by_id.get(self.prefixes[index][1])
+        return None
 
 
 class Location(Base):
@@ -26,58 +107,119 @@ class Location(Base):
         "GMD": "Ganymede",
     }
     LOCATION_NAMES = set()
+    CODE_MISSES = set()  # Коды, для которых не нашлось ни одной похожей локации (сбрасываются при новой локации)
+    REGISTRY = LocationRegistry(())
+    _create_lock = threading.Lock()
 
     outgoing_ships = relationship("Ship", back_populates="origin", foreign_keys='Ship.origin_id')
     incoming_ships = relationship("Ship", back_populates="destination", foreign_keys='Ship.destination_id')
 
     @hybrid_property
     def is_space(self) -> bool:
-        return self.name == "Space"
+        return self.name == SPACE_NAME
 
     @classmethod
-    def get_create_location(cls, name: str, session: Session) -> 'Location':
-        location = session.query(Location).filter_by(name=name).first()
-        if location is None:
-            location = Location(name=name)
-            session.add(location)
-            session.commit()
-            cls.init_database(session)
+    def get_info(cls, location_id: int) -> Optional[LocationInfo]:
+        return cls.REGISTRY.by_id.get(location_id)
+
+    @classmethod
+    def get_name(cls, location_id: int) -> Optional[str]:
+        location = cls.REGISTRY.by_id.get(location_id)
+        return location.name if location else None
+
+    @classmethod
+    def is_space_id(cls, location_id: int) -> bool:
+        return location_id is not None and location_id == cls.REGISTRY.space_id
 
-            # cls.LOCATION_NAMES.add(location.name)
-        return location
+    @classmethod
+    def get_location_id(cls, name: str) -> int:
+        """
+        Id локации по имени из реестра. Новая локация создаётся в отдельной транзакции, после чего реестр обновляется
+        """
+        location = cls.REGISTRY.by_name.get(name)
+        if location is not None:
+            return location.id
+        with cls._create_lock:
+            location = cls.REGISTRY.by_name.get(name)
+            if location is not None:
+                return location.id
+            session = SessionMaker()
+            try:
+                if session.query(Location).filter_by(name=name).first() is None:
+                    session.add(Location(name=name))
+                    session.commit()
+                cls.init_database(session)
+            finally:
+                session.close()
+        return cls.REGISTRY.by_name.get(name).id
 
     @classmethod
-    def get_location_by_code(cls, code: str, session: Session) -> 'Location':
+    def get_location_id_by_code(cls, code: str) -> Optional[int]:
         name = cls.CODES.get(code)
         if name is None:
-            name = max(cls.LOCATION_NAMES, key=lambda cur_name: fuzz.token_set_ratio(
-                cur_name, code, force_ascii=False) if cur_name not in cls.LOCATION_NAMES else
-                fuzz.token_set_ratio(cur_name, code, force_ascii=False) * 0.1)
+            if code in cls.CODE_MISSES:
+                return None
+            name, confidence = cls.REGISTRY.guess_code(code)
             if name is None:
                 logging.error("Can not find name corresponding to code {}".format(code))
+                cls.CODE_MISSES.add(code)
                 return None
-            logging.warning("Can not find name corresponding to code {}, assuming it is {}".format(code, name))
+            logging.warning("Can not find name corresponding to code {}, assuming it is {} (confidence {})".format(
+                code, name, confidence))
             cls.CODES.update({code: name})
-        location = cls.get_create_location(name, session)
-        return location
+            cls.save_code(code, name, confidence)
+        return cls.get_location_id(name)
+
+    @classmethod
+    def save_code(cls, code: str, name: str, confidence: int):
+        """
+        Запоминает угаданный код в базе, чтобы не угадывать его заново после перезапуска
+        """
+        session = SessionMaker()
+        try:
+            session.execute(insert(LocationCode.__table__).values(
+                code=code, location_id=cls.get_location_id(name), confidence=confidence
+            ).on_conflict_do_nothing(index_elements=["code"]))
+            session.commit()
+        except Exception:
+            logging.exception("Can not save location code {}".format(code))
+        finally:
+            session.close()
 
     @classmethod
-    def search_location(cls, name: str, session: Session) -> 'Location':
+    def search_location(cls, name: str, session: Session = None) -> Optional[LocationInfo]:
         """
         Поиск локации по имени (Не зависит от регистра, можно написать только начало названия - lun найдёт Luna)
+        Поиск идёт по реестру в памяти, база не используется
         :param name:
         :param session:
         :return:
         """
-        return session.query(Location).filter(Location.name.ilike("{}%".format(name))).first()
+        return cls.REGISTRY.search(name)
 
     @classmethod
     def init_database(cls, session: Session):
-        cls.LOCATION_NAMES.clear()
-        locations = session.query(Location).all()
-        list(map(lambda location: cls.LOCATION_NAMES.add(location.name),
-                 filter(lambda location: not location.is_space, locations)))
-        space_location = first(locations, key=lambda location: location.is_space)
-        cls.SPACE_ID = space_location.id if space_location else None
-
+        locations = list(map(lambda location: LocationInfo(location.id, location.name, location.is_space),
+                             session.query(Location).all()))
+        cls.LOCATION_NAMES = set(map(lambda location: location.name,
+                                     filter(lambda location: not location.is_space, locations)))
+        cls.REGISTRY = LocationRegistry(locations)
+        cls.SPACE_ID = cls.REGISTRY.space_id
+        cls.CODE_MISSES = set()
+        for location_code in session.query(LocationCode).all():
+            location = cls.REGISTRY.by_id.get(location_code.location_id)
+            if location is not None and location_code.code not in cls.CODES:
+                cls.CODES.update({location_code.code: location.name})
+
+
+class LocationCode(Base):
+    """
+    Коды локаций, угаданные нечётким поиском
+    """
+    __tablename__ = "location_codes"
+    id = Column(INT, primary_key=True)
+    code = Column(VARCHAR, unique=True)
+    location_id = Column(INT, ForeignKey("locations.id"))
+    confidence = Column(INT)
 
+    location = relationship("Location")
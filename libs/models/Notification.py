@@ -0,0 +1,55 @@
+from sqlalchemy import Column, INT, VARCHAR, TIMESTAMP, BIGINT, Index, or_
+from sqlalchemy import text as sql_text
+from sqlalchemy.orm import Session
+
+from resources.globals import Base
+
+from typing import List
+
+import datetime
+
+
+class Notification(Base):
+    """
+    Исходящие уведомления (outbox). Пишутся в той же транзакции, что и событие, отправляются отдельной стадией
+    (bin/notifications.py), после отправки помечаются доставленными
+    """
+    __tablename__ = "notifications"
+    id = Column(INT, primary_key=True)
+    chat_id = Column(BIGINT, nullable=False)
+    text = Column(VARCHAR, nullable=False)
+    parse_mode = Column(VARCHAR)
+    created_date = Column(TIMESTAMP, nullable=False)
+    dispatched_date = Column(TIMESTAMP)  # Передано боту на отправку
+    delivered_date = Column(TIMESTAMP)  # Telegram подтвердил отправку
+    attempts = Column(INT, nullable=False, default=0, server_default=sql_text("0"))
+
+    __table_args__ = (
+        Index("ix_notifications_pending", "id", postgresql_where=delivered_date.is_(None)),
+    )
+
+    # Через сколько переданное, но не подтверждённое уведомление отправляется снова
+    DELIVERY_TIMEOUT = datetime.timedelta(minutes=5)
+    MAX_ATTEMPTS = 3
+
+    @classmethod
+    def take_pending(cls, session: Session, now: datetime.datetime, limit: int) -> List['Notification']:
+        """
+        Забирает неотправленные уведомления на отправку: отмечает время передачи и попытку (без коммита).
+        Строки блокируются FOR UPDATE SKIP LOCKED - параллельные стадии не возьмут одно уведомление дважды
+        """
+        notifications = session.query(Notification).\
+            filter(Notification.delivered_date.is_(None)).\
+            filter(Notification.attempts < cls.MAX_ATTEMPTS).\
+            filter(or_(Notification.dispatched_date.is_(None),
+                       Notification.dispatched_date < now - cls.DELIVERY_TIMEOUT)).\
+            order_by(Notification.id).limit(limit).with_for_update(skip_locked=True).all()
+        for notification in notifications:
+            notification.dispatched_date = now
+            notification.attempts += 1
+        return notifications
+
+    @classmethod
+    def mark_delivered(cls, notification_id: int, session: Session, now: datetime.datetime):
+        session.query(Notification).filter(Notification.id == notification_id).\
+            update({Notification.delivered_date: now}, synchronize_session=False)
@@ -1,27 +1,50 @@
 
-from sqlalchemy import Column, ForeignKey, INT, VARCHAR, BOOLEAN, TIMESTAMP, Table, not_, BIGINT
+from sqlalchemy import Column, ForeignKey, INT, VARCHAR, BOOLEAN, TIMESTAMP, Table, BIGINT, Index, text
 from sqlalchemy.orm import relationship, Session
+from sqlalchemy.dialects.postgresql import insert
 
+from collections import defaultdict
+from typing import Dict, Iterable
+
+import io
+import csv
 import datetime
 
 from resources.globals import Base
 
-from bin.service import get_current_datetime
+from bin.service import get_current_datetime, chunks
 
-from libs.models.Location import Location
+from libs.models.Location import Location, LocationInfo
 from libs.models.Ship import Ship, suitable_ships_table, crashed_ships_table, subscribed_ships_table
 
 
-class Player(Base):
+class PlayerFormatMixin:
+    """
+    Отображение игрока. Общее для модели Player и PlayerRecord из снапшота (libs/snapshot.py)
+    """
+    __slots__ = ()
+
+    @property
+    def location_info(self) -> LocationInfo:
+        return Location.get_info(self.location_id)
+
+    def short_format(self) -> str:
+        return "#<code>{:<2} 🏅{:<1}</code> [{}] {}\n".format(self.rank, self.lvl, self.faction, self.username)
+
+
+class Player(PlayerFormatMixin, Base):
     __tablename__ = "players"
     id = Column(INT, primary_key=True)
-    game_id = Column(VARCHAR)
+    game_id = Column(VARCHAR, unique=True)
     username = Column(VARCHAR)
     lvl = Column(INT)
     exp = Column(INT)
     faction = Column(VARCHAR)
     location_id = Column(INT, ForeignKey("locations.id"))
+    last_planet_id = Column(INT, ForeignKey("locations.id"))  # Последняя не космическая локация (в т.ч. текущая)
     rank = Column(INT)
+    # Денормализован из suitable_ships, пересчитывается в конце стадий тика (refresh_current_ships)
+    current_ship_id = Column(INT, ForeignKey("ships.id"))
 
     guild_id = Column(INT, ForeignKey("guilds.id"))
 
@@ -31,8 +54,10 @@ class Player(Base):
     rank_history = relationship("PlayerRankChanges")
     location_history = relationship("PlayerLocationChanges")
 
-    location = relationship("Location")
+    location = relationship("Location", foreign_keys=[location_id])
+    last_planet = relationship("Location", foreign_keys=[last_planet_id])
     guild = relationship("Guild")
+    current_ship = relationship("Ship", foreign_keys=[current_ship_id])
 
     location_changes: list = relationship("PlayerLocationChanges")
 
@@ -40,145 +65,255 @@ class Player(Base):
     crashed_ships = relationship("Ship", secondary=crashed_ships_table, back_populates="crashed_players")
     subscribed_ships = relationship("Ship", secondary=subscribed_ships_table, back_populates="subscribed_players")
 
-    @property
-    def current_ship(self):
-        if self.location and self.location.is_space:
-            if self.possible_ships:
-                return self.possible_ships[0]
-
     @staticmethod
-    def get_create_player(game_id: str, session: Session):
-        player = session.query(Player).filter_by(game_id=game_id).first()
-        if player is None:
-            player = Player(game_id=game_id)
-            session.add(player)
-            session.commit()
-        return player
+    def load_players(session: Session, game_ids: Iterable[str] = None) -> Dict[str, 'Player']:
+        """
+        Загружает игроков одним запросом
+        :param game_ids: Загрузить только этих игроков (по умолчанию - всех)
+        :return: {game_id: Player}
+        """
+        query = session.query(Player)
+        if game_ids is not None:
+            query = query.filter(Player.game_id.in_(list(game_ids)))
+        return {player.game_id: player for player in query.all()}
+
+    # Фактический текущий корабль по таблице связей: players.id, ship_id
+    CURRENT_SHIP_SELECT = """
+        SELECT players.id,
+               CASE WHEN players.location_id = :space_id THEN
+                   (SELECT min(suitable_ships.ship_id) FROM suitable_ships WHERE suitable_ships.player_id = players.id)
+               END AS ship_id
+        FROM players
+    """
+    CURRENT_SHIP_MISMATCH = "players.current_ship_id IS DISTINCT FROM actual.ship_id"
 
-    def short_format(self) -> str:
-        return "#<code>{:<2} 🏅{:<1}</code> [{}] {}\n".format(self.rank, self.lvl, self.faction, self.username)
+    @staticmethod
+    def refresh_current_ships(session: Session, player_ids: Iterable[int]):
+        """
+        Пересчитывает current_ship_id игроков player_ids одним UPDATE в текущей транзакции (без коммита).
+        Переписываются только изменившиеся строки
+        :param player_ids: Игроки, сменившие локацию в этом тике
+        """
+        player_ids = list(set(player_ids))
+        if not player_ids:
+            return
+        session.flush()
+        session.execute(text(
+            "UPDATE players SET current_ship_id = actual.ship_id FROM ({} WHERE players.id = ANY(:player_ids)) "
+            "AS actual WHERE players.id = actual.id AND {}".format(
+                Player.CURRENT_SHIP_SELECT, Player.CURRENT_SHIP_MISMATCH)),
+            {"space_id": Location.SPACE_ID, "player_ids": player_ids})
 
-    def check_update_data(self, exp: int, lvl: int, rank: int, location: 'Location', faction: str, username: str,
-                          session: Session):
+    @staticmethod
+    def create_players(game_ids: Iterable[str], session: Session) -> Dict[str, 'Player']:
+        """
+        Создаёт недостающих игроков одним INSERT ... ON CONFLICT DO NOTHING (без коммита)
+        :return: {game_id: Player} для всех переданных game_ids
+        """
+        game_ids = list(set(game_ids))
+        if not game_ids:
+            return {}
+        session.execute(
+            insert(Player.__table__).values([{"game_id": game_id} for game_id in game_ids]).
+            on_conflict_do_nothing(index_elements=["game_id"])
+        )
+        players = session.query(Player).filter(Player.game_id.in_(game_ids)).all()
+        return {player.game_id: player for player in players}
+
+    def check_update_data(self, exp: int, lvl: int, rank: int, location_id: int, faction: str, username: str,
+                          session: Session, commit: bool = True, history: 'PlayerHistoryWriter' = None):
+        """
+        :param history: Если передан, изменения не добавляются в сессию как ORM объекты, а копятся в history
+                        и записываются пачкой (PlayerHistoryWriter.write)
+        """
         if exp != self.exp:
-            self.update_exp(exp, session)
+            self.update_exp(exp, session, history)
         if lvl != self.lvl:
-            self.update_lvl(lvl, session)
+            self.update_lvl(lvl, session, history)
         if rank != self.rank:
-            self.update_rank(rank, session)
-        if location != self.location:
-            self.update_location(location, session)
+            self.update_rank(rank, session, history)
+        if location_id != self.location_id:
+            self.update_location(location_id, session, history)
         if faction != self.faction:
-            self.update_faction(faction, session)
+            self.update_faction(faction, session, history)
         if username != self.username:
-            self.update_username(username, session)
+            self.update_username(username, session, history)
 
         session.add(self)
-        session.commit()
+        if commit:
+            session.commit()
 
-    def update_exp(self, exp: int, session: Session):
-        change = PlayerExpChanges(player=self, new_value=exp, date=get_current_datetime())
+    def add_change(self, model, value, session: Session, history: 'PlayerHistoryWriter' = None):
+        date = get_current_datetime()
+        if history is not None:
+            history.add(model, self.id, value, date)
+        elif model is PlayerLocationChanges:
+            session.add(PlayerLocationChanges(player=self, new_location_id=value, date=date))
+        else:
+            session.add(model(player=self, new_value=value, date=date))
+
+    def update_exp(self, exp: int, session: Session, history: 'PlayerHistoryWriter' = None):
+        self.add_change(PlayerExpChanges, exp, session, history)
         self.exp = exp
-        session.add(change)
 
-    def update_lvl(self, lvl: int, session: Session):
-        change = PlayerLvlChanges(player=self, new_value=lvl, date=get_current_datetime())
+    def update_lvl(self, lvl: int, session: Session, history: 'PlayerHistoryWriter' = None):
+        self.add_change(PlayerLvlChanges, lvl, session, history)
         self.lvl = lvl
-        session.add(change)
 
-    def update_rank(self, rank: int, session: Session):
-        change = PlayerRankChanges(player=self, new_value=rank, date=get_current_datetime())
+    def update_rank(self, rank: int, session: Session, history: 'PlayerHistoryWriter' = None):
+        self.add_change(PlayerRankChanges, rank, session, history)
         self.rank = rank
-        session.add(change)
-
-    def update_location(self, location: 'Location', session: Session):
-        change = PlayerLocationChanges(player=self, location=location, date=get_current_datetime())
-        if self.location and self.location.is_space and not location.is_space:
-            last_location_change = session.query(PlayerLocationChanges).join(Player).\
-                join(PlayerLocationChanges.location).filter(Player.id == self.id).\
-                filter(not_(Location.is_space)).order_by(PlayerLocationChanges.date.desc()).first()
-            if last_location_change and location.id == last_location_change.location.id:
+
+    def update_location(self, location_id: int, session: Session, history: 'PlayerHistoryWriter' = None):
+        if Location.is_space_id(self.location_id) and not Location.is_space_id(location_id):
+            if location_id == self.last_planet_id:
                 # Пацаны разбились
                 if self.current_ship:
                     self.crashed_ships.append(self.current_ship)
             self.possible_ships.clear()
-        self.location = location
-        session.add(change)
-
-    def update_faction(self, faction: str, session: Session):
-        change = PlayerFactionChanges(player=self, new_value=faction, date=get_current_datetime())
+        if not Location.is_space_id(location_id):
+            self.last_planet_id = location_id
+        elif self.location_id is not None:
+            # Вылет с планеты
+            self.last_planet_id = self.location_id
+        self.add_change(PlayerLocationChanges, location_id, session, history)
+        self.location_id = location_id
+
+    def update_faction(self, faction: str, session: Session, history: 'PlayerHistoryWriter' = None):
+        self.add_change(PlayerFactionChanges, faction, session, history)
         self.faction = faction
-        session.add(change)
 
-    def update_username(self, username: str, session: Session):
-        change = PlayerUsernameChanges(player=self, new_value=username, date=get_current_datetime())
+    def update_username(self, username: str, session: Session, history: 'PlayerHistoryWriter' = None):
+        self.add_change(PlayerUsernameChanges, username, session, history)
         self.username = username
-        session.add(change)
 
 
+def history_table_args(table_name: str) -> tuple:
+    """
+    Таблицы истории разбиты на помесячные партиции по date (см. libs/partitions.py), поэтому date входит в PK
+    """
+    return (
+        Index("ix_{}_player_id_date".format(table_name), "player_id", "date"),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
 
 
 class PlayerExpChanges(Base):
     __tablename__ = "exp_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_value: int = Column(INT)
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
 
 
 class PlayerLvlChanges(Base):
     __tablename__ = "lvl_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_value: int = Column(INT)
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
 
 
 class PlayerRankChanges(Base):
     __tablename__ = "rank_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_value: int = Column(INT)
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
 
 
 class PlayerFactionChanges(Base):
     __tablename__ = "faction_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_value: str = Column(VARCHAR)
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
 
 
 class PlayerUsernameChanges(Base):
     __tablename__ = "username_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_value: str = Column(VARCHAR)
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
 
 
 class PlayerLocationChanges(Base):
     __tablename__ = "location_changes"
-    id = Column(INT, primary_key=True)
+    __table_args__ = history_table_args(__tablename__)
+    id = Column(INT, primary_key=True, autoincrement=True)
     player_id: int = Column(INT, ForeignKey("players.id"))
     new_location_id: int = Column(INT, ForeignKey("locations.id"))
-    date: datetime.datetime = Column(TIMESTAMP)
+    date: datetime.datetime = Column(TIMESTAMP, primary_key=True)
 
     player = relationship("Player")
     location = relationship("Location")
 
 
+class PlayerHistoryWriter:
+    """
+    Копит изменения игроков за тик в виде кортежей (player_id, value, date) и записывает их
+    одним многострочным INSERT на таблицу, а на PostgreSQL - через COPY
+    """
+    INSERT_BATCH_SIZE = 5000
+    VALUE_COLUMNS = {PlayerLocationChanges: "new_location_id"}
+
+    def __init__(self, use_copy: bool = True):
+        self.use_copy = use_copy
+        self.rows = defaultdict(list)
+
+    def add(self, model, player_id: int, value, date: datetime.datetime):
+        self.rows[model].append((player_id, value, date))
+
+    def __len__(self):
+        return sum(map(len, self.rows.values()))
+
+    def write(self, session: Session):
+        """
+        Записывает накопленные изменения в текущей транзакции сессии (без коммита) и очищает буфер
+        """
+        use_copy = self.use_copy and session.bind.dialect.name == "postgresql"
+        for model, rows in self.rows.items():
+            if not rows:
+                continue
+            columns = ("player_id", self.VALUE_COLUMNS.get(model, "new_value"), "date")
+            if use_copy:
+                self._copy(model.__tablename__, columns, rows, session)
+            else:
+                for chunk in chunks(rows, self.INSERT_BATCH_SIZE):
+                    session.execute(model.__table__.insert().values(list(map(lambda row: dict(zip(columns, row)),
+                                                                             chunk))))
+        self.rows.clear()
+
+    @staticmethod
+    def _copy(table_name: str, columns, rows, session: Session):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows(map(lambda row: tuple(map(lambda value: "\\N" if value is None else value, row)), rows))
+        buffer.seek(0)
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+                table_name, ", ".join(columns)), buffer)
+        finally:
+            cursor.close()
+
+
 def provide_player(func):
     def wrapper(*args, **kwargs):
         session, update = args[-1], args[1]
@@ -1,13 +1,17 @@
 
-from sqlalchemy import Column, ForeignKey, INT, VARCHAR, BOOLEAN, TIMESTAMP, FLOAT, Table
+from sqlalchemy import Column, ForeignKey, INT, VARCHAR, BOOLEAN, TIMESTAMP, FLOAT, Table, Index, text
 from sqlalchemy.orm import relationship, Session
+from sqlalchemy.dialects.postgresql import insert
 
 from resources.globals import Base
 
-from libs.models.Location import Location
+from libs.models.Location import Location, LocationInfo
 
 from bin.service import get_current_datetime, pretty_time_format
 
+from collections import defaultdict
+from typing import Dict, Iterable, List, Tuple
+
 import re
 import logging
 import datetime
@@ -17,12 +21,15 @@ suitable_ships_table = Table(
     'suitable_ships', Base.metadata,
     Column("player_id", INT, ForeignKey("players.id")),
     Column("ship_id", INT, ForeignKey("ships.id")),
+    Index("ix_suitable_ships_player_id", "player_id"),
+    Index("ix_suitable_ships_ship_id", "ship_id"),
 )
 
 crashed_ships_table = Table(
     'crashed_ships', Base.metadata,
     Column("player_id", INT, ForeignKey("players.id")),
     Column("ship_id", INT, ForeignKey("ships.id")),
+    Index("ix_crashed_ships_ship_id", "ship_id"),
 )
 
 subscribed_ships_table = Table(
@@ -32,25 +39,11 @@ subscribed_ships_table = Table(
 )
 
 
-class Ship(Base):
-    __tablename__ = "ships"
-    id = Column(INT, primary_key=True)
-    ship_id = Column(VARCHAR, unique=True)
-    name = Column(VARCHAR)
-    code = Column(VARCHAR)
-    type = Column(VARCHAR)
-    status = Column(VARCHAR)
-    origin_id = Column(INT, ForeignKey("locations.id"))
-    destination_id = Column(INT, ForeignKey("locations.id"))
-    progress = Column(FLOAT)
-    departed_date = Column(TIMESTAMP)
-
-    origin = relationship("Location", foreign_keys=[origin_id], back_populates="outgoing_ships")
-    destination = relationship("Location", foreign_keys=[destination_id], back_populates="incoming_ships")
-
-    possible_players = relationship("Player", secondary=suitable_ships_table, back_populates="possible_ships")
-    crashed_players = relationship("Player", secondary=crashed_ships_table, back_populates="crashed_ships")
-    subscribed_players = relationship("Player", secondary=subscribed_ships_table, back_populates="subscribed_ships")
+class ShipFormatMixin:
+    """
+    Отображение корабля. Общее для модели Ship и ShipRecord из снапшота (libs/snapshot.py)
+    """
+    __slots__ = ()
 
     _status_to_emoji = {
         "preparing": "💤",
@@ -59,6 +52,14 @@ class Ship(Base):
         "crashed": "💥"
     }
 
+    @property
+    def origin_info(self) -> LocationInfo:
+        return Location.get_info(self.origin_id)
+
+    @property
+    def destination_info(self) -> LocationInfo:
+        return Location.get_info(self.destination_id)
+
     @property
     def status_emoji(self) -> str:
         emoji = self._status_to_emoji.get(self.status, "")
@@ -68,39 +69,110 @@ class Ship(Base):
 
     @property
     def crashed(self) -> bool:
-        return bool(self.crashed_players)
+        return bool(self.is_crashed)
 
     def format_line(self, outgoing=True):
         return "{}<code>{}</code> {} <code>{:<8}</code> {} /sh_{}\n".format(
             self.status_emoji, self.code, "→" if outgoing else "←",
-            self.destination.name if outgoing else self.origin.name,
+            self.destination_info.name if outgoing else self.origin_info.name,
             "({}% {})".format(int(self.progress),
                               pretty_time_format(self.departed_date) if self.departed_date else "")
             if self.progress is not None else "<code>         </code>", self.id)
 
-    @classmethod
-    def get_create_ship(cls, ship_id: str, session: Session) -> 'Ship':
-        ship = session.query(Ship).filter_by(ship_id=ship_id).first()
-        if ship is None:
-            ship = Ship(ship_id=ship_id)
-            session.add(ship)
-            session.commit()
-        return ship
-
-    @property
-    def departed_now(self):
-        return self.departed_date is not None and \
-               get_current_datetime() - self.departed_date <= datetime.timedelta(minutes=1)
-
     def calculate_arrival(self):
+        """
+        Прогноз, посчитанный при обновлении кораблей (libs/eta.py), иначе - экстраполяция от времени отправления
+        """
+        if self.arrival_date is not None:
+            return self.arrival_date
         if self.departed_date and self.progress:
             return self.departed_date + (get_current_datetime() - self.departed_date) / self.progress * 100
 
     def format_short(self, show_link=True):
-        return "{} -> {} {}%{}".format(self.origin.name, self.destination.name, self.progress,
+        return "{} -> {} {}%{}".format(self.origin_info.name, self.destination_info.name, self.progress,
                                         " /sh_{}".format(self.id) if show_link else "")
 
-    def determine_locations(self, session: Session):
+
+class Ship(ShipFormatMixin, Base):
+    __tablename__ = "ships"
+    id = Column(INT, primary_key=True)
+    ship_id = Column(VARCHAR, unique=True)
+    name = Column(VARCHAR)
+    code = Column(VARCHAR)
+    type = Column(VARCHAR)
+    status = Column(VARCHAR)
+    origin_id = Column(INT, ForeignKey("locations.id"))
+    destination_id = Column(INT, ForeignKey("locations.id"))
+    progress = Column(FLOAT)
+    departed_date = Column(TIMESTAMP)
+    arrival_date = Column(TIMESTAMP)  # Прогноз прибытия по замерам прогресса (libs/eta.py)
+
+    # Денормализованы из crashed_ships и suitable_ships, пересчитываются в конце стадий тика (refresh_status_columns)
+    is_crashed = Column(BOOLEAN, nullable=False, default=False, server_default=text("false"))
+    passengers_count = Column(INT, nullable=False, default=0, server_default=text("0"))
+
+    # Фактические значения по таблицам связей: ships.id, passengers_count, is_crashed
+    STATUS_COLUMNS_SELECT = """
+        SELECT ships.id,
+               (SELECT count(*) FROM suitable_ships WHERE suitable_ships.ship_id = ships.id) AS passengers_count,
+               EXISTS (SELECT 1 FROM crashed_ships WHERE crashed_ships.ship_id = ships.id) AS is_crashed
+        FROM ships
+    """
+    STATUS_COLUMNS_MISMATCH = "ships.passengers_count IS DISTINCT FROM actual.passengers_count OR " \
+                              "ships.is_crashed IS DISTINCT FROM actual.is_crashed"
+
+    origin = relationship("Location", foreign_keys=[origin_id], back_populates="outgoing_ships")
+    destination = relationship("Location", foreign_keys=[destination_id], back_populates="incoming_ships")
+
+    possible_players = relationship("Player", secondary=suitable_ships_table, back_populates="possible_ships")
+    crashed_players = relationship("Player", secondary=crashed_ships_table, back_populates="crashed_ships")
+    subscribed_players = relationship("Player", secondary=subscribed_ships_table, back_populates="subscribed_ships")
+
+    @classmethod
+    def load_ships(cls, session: Session, ship_ids: Iterable[str] = None) -> Dict[str, 'Ship']:
+        """
+        Загружает корабли одним запросом
+        :param ship_ids: Загрузить только эти корабли (по умолчанию - все)
+        :return: {ship_id: Ship}
+        """
+        query = session.query(Ship)
+        if ship_ids is not None:
+            query = query.filter(Ship.ship_id.in_(list(ship_ids)))
+        return {ship.ship_id: ship for ship in query.all()}
+
+    @classmethod
+    def create_ships(cls, ship_ids: Iterable[str], session: Session) -> Dict[str, 'Ship']:
+        """
+        Создаёт недостающие корабли одним INSERT ... ON CONFLICT DO NOTHING (без коммита)
+        :return: {ship_id: Ship} для всех переданных ship_ids
+        """
+        ship_ids = list(set(ship_ids))
+        if not ship_ids:
+            return {}
+        session.execute(
+            insert(Ship.__table__).values([{"ship_id": ship_id} for ship_id in ship_ids]).
+            on_conflict_do_nothing(index_elements=["ship_id"])
+        )
+        ships = session.query(Ship).filter(Ship.ship_id.in_(ship_ids)).all()
+        return {ship.ship_id: ship for ship in ships}
+
+    @classmethod
+    def refresh_status_columns(cls, session: Session, ship_ids: Iterable[int]):
+        """
+        Пересчитывает is_crashed и passengers_count кораблей ship_ids одним UPDATE в текущей транзакции
+        (без коммита). Переписываются только изменившиеся строки
+        :param ship_ids: Корабли, чьи пассажиры или разбившиеся могли измениться в этом тике
+        """
+        ship_ids = list(set(ship_ids))
+        if not ship_ids:
+            return
+        session.flush()
+        session.execute(text(
+            "UPDATE ships SET passengers_count = actual.passengers_count, is_crashed = actual.is_crashed "
+            "FROM ({} WHERE ships.id = ANY(:ship_ids)) AS actual WHERE ships.id = actual.id AND ({})".format(
+                cls.STATUS_COLUMNS_SELECT, cls.STATUS_COLUMNS_MISMATCH)), {"ship_ids": ship_ids})
+
+    def determine_locations(self, session: Session, commit: bool = True):
         parse = re.match("(.+)\n(\\w+) -\u003e(\\w+)", self.status)
         if parse is None:
             logging.error("Can not parse status: {}".format(self.status))
@@ -115,11 +187,50 @@ class Ship(Base):
             # Долетел корабль
             if self.crashed:
                 self.crashed_players.clear()
-        self.origin, self.destination = \
-            Location.get_location_by_code(origin_code, session), \
-            Location.get_location_by_code(destination_code, session)
+                self.is_crashed = False
+        self.origin_id, self.destination_id = \
+            Location.get_location_id_by_code(origin_code), Location.get_location_id_by_code(destination_code)
         self.status = status
         session.add(self)
-        session.commit()
+        if commit:
+            session.commit()
 
 
+class DepartureIndex:
+    """
+    Корабли, отправившиеся за последнее окно, по локации отправления.
+    Заполняется стадией кораблей, стадия игроков по нему определяет пассажиров вылетевших игроков.
+    Все проверки идут относительно общего времени тика, а не текущего времени.
+    """
+    WINDOW = datetime.timedelta(minutes=1)
+
+    def __init__(self):
+        self.departures: Dict[int, Tuple[int, datetime.datetime]] = {}  # ship.id -> (origin_id, departed_date)
+        self.loaded = False
+
+    def load(self, session: Session, now: datetime.datetime):
+        """
+        Восстанавливает недавние отправления из базы (после перезапуска)
+        """
+        ships = session.query(Ship.id, Ship.origin_id, Ship.departed_date).\
+            filter(Ship.departed_date >= now - self.WINDOW).all()
+        for ship_id, origin_id, departed_date in ships:
+            self.departures.setdefault(ship_id, (origin_id, departed_date))
+        self.loaded = True
+
+    def record(self, ship_id: int, origin_id: int, departed_date: datetime.datetime):
+        self.departures.update({ship_id: (origin_id, departed_date)})
+
+    def prune(self, now: datetime.datetime):
+        self.departures = {ship_id: departure for ship_id, departure in self.departures.items()
+                           if now - departure[1] <= self.WINDOW}
+
+    def by_origin(self, now: datetime.datetime) -> Dict[int, List[int]]:
+        """
+        :return: {origin_id: [ship.id]} для кораблей, отправившихся не раньше now - WINDOW
+        """
+        result = defaultdict(list)
+        for ship_id, (origin_id, departed_date) in self.departures.items():
+            if now - departed_date <= self.WINDOW:
+                result[origin_id].append(ship_id)
+        return dict(result)
@@ -0,0 +1,105 @@
+from sqlalchemy import text
+
+from typing import List, Optional, Tuple
+
+import re
+import logging
+import datetime
+
+# Таблицы истории изменений игроков, разбитые на помесячные партиции по date
+HISTORY_TABLES = ("exp_changes", "lvl_changes", "rank_changes", "location_changes", "faction_changes",
+                  "username_changes")
+# Строки истории без даты при переходе на партиции получили эту дату и лежат в своей партиции -
+# политика хранения отцепляет её первой
+UNDATED_MONTH = datetime.date(1970, 1, 1)
+
+
+def month_start(date: datetime.date) -> datetime.date:
+    return datetime.date(date.year, date.month, 1)
+
+
+def add_months(date: datetime.date, months: int) -> datetime.date:
+    month = date.month - 1 + months
+    return datetime.date(date.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(table: str, month: datetime.date) -> str:
+    return "{}_y{}m{:02}".format(table, month.year, month.month)
+
+
+def parse_partition_month(table: str, name: str) -> Optional[datetime.date]:
+    parse = re.fullmatch("{}_y(\\d{{4}})m(\\d{{2}})".format(re.escape(table)), name)
+    if parse is None:
+        return None
+    return datetime.date(int(parse.group(1)), int(parse.group(2)), 1)
+
+
+def default_partition_name(table: str) -> str:
+    return "{}_default".format(table)
+
+
+def is_partition_name(name: str) -> bool:
+    """
+    Имя помесячной партиции или партиции по умолчанию одной из HISTORY_TABLES
+    """
+    return any(map(lambda table: name == default_partition_name(table) or
+                   parse_partition_month(table, name) is not None, HISTORY_TABLES))
+
+
+def create_partition_sql(table: str, month: datetime.date) -> str:
+    return "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+        partition_name(table, month), table, month.isoformat(), add_months(month, 1).isoformat())
+
+
+def create_default_partition_sql(table: str) -> str:
+    return "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT".format(default_partition_name(table), table)
+
+
+def list_partitions(connection, table: str) -> List[Tuple[str, datetime.date]]:
+    """
+    :return: [(имя партиции, месяц)] для помесячных партиций таблицы (партиция по умолчанию не включается)
+    """
+    names = connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table"
+    ), {"table": table}).fetchall()
+    partitions = map(lambda row: (row[0], parse_partition_month(table, row[0])), names)
+    return sorted(filter(lambda partition: partition[1] is not None, partitions), key=lambda partition: partition[1])
+
+
+def ensure_partitions(connection, today: datetime.date, months_ahead: int = 2):
+    """
+    Создаёт партиции на текущий и months_ahead следующих месяцев, чтобы новые строки не попадали в DEFAULT
+    """
+    current_month = month_start(today)
+    for table in HISTORY_TABLES:
+        connection.execute(text(create_default_partition_sql(table)))
+        for i in range(months_ahead + 1):
+            connection.execute(text(create_partition_sql(table, add_months(current_month, i))))
+
+
+def apply_retention(connection, today: datetime.date, retention_months: int, archive_schema: str = None) -> List[str]:
+    """
+    Отцепляет партиции старше retention_months месяцев и удаляет их (или переносит в archive_schema).
+    Это операции над метаданными, без DELETE по строкам.
+    :return: Имена обработанных партиций
+    """
+    cutoff = add_months(month_start(today), -retention_months)
+    processed = []
+    if archive_schema:
+        connection.execute(text("CREATE SCHEMA IF NOT EXISTS {}".format(archive_schema)))
+    for table in HISTORY_TABLES:
+        for name, month in list_partitions(connection, table):
+            if month >= cutoff:
+                break
+            connection.execute(text("ALTER TABLE {} DETACH PARTITION {}".format(table, name)))
+            if archive_schema:
+                connection.execute(text("ALTER TABLE {} SET SCHEMA {}".format(name, archive_schema)))
+                logging.info("History partition {} archived to {}".format(name, archive_schema))
+            else:
+                connection.execute(text("DROP TABLE {}".format(name)))
+                logging.info("History partition {} dropped".format(name))
+            processed.append(name)
+    return processed
@@ -0,0 +1,107 @@
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
+
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Лимиты Telegram на отправку: общий token bucket (сообщений в секунду) и скользящие окна по чатам
+    (сообщений в секунду и, для групп, в минуту).
+    acquire не ждёт сам: либо занимает слот, либо сразу говорит, сколько ждать до следующего - ждать можно без блокировки
+    """
+    CHAT_SECOND_WINDOW = 1
+    CHAT_MINUTE_WINDOW = 60
+    # RetryAfter от стольких разных чатов за секунду - общий флуд-лимит бота, а не лимит чата
+    GLOBAL_RETRY_AFTER_CHATS = 3
+    SWEEP_INTERVAL = 60  # seconds, как часто выбрасываются окна неактивных чатов
+
+    def __init__(self, per_second: int, per_chat_second: int, per_chat_minute: int,
+                 clock: Callable[[], float] = time.monotonic):
+        self.per_second = per_second
+        self.per_chat_second = per_chat_second
+        self.per_chat_minute = per_chat_minute
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = float(per_second)
+        self.refilled = clock()
+        self.chat_seconds: Dict[int, Deque[float]] = {}  # chat_id -> время отправок за последнюю секунду
+        self.chat_minutes: Dict[int, Deque[float]] = {}  # chat_id -> время отправок за последнюю минуту
+        self.chat_paused: Dict[int, float] = {}  # chat_id -> до какого времени чат ждёт после RetryAfter
+        self.paused = 0.0  # До какого времени ждут все чаты
+        self.retry_afters: Deque[Tuple[float, int]] = deque()  # (время, chat_id) RetryAfter за последнюю секунду
+        self.swept = self.refilled
+
+    @staticmethod
+    def is_group(chat_id: int) -> bool:
+        # Личка - любое число сообщений в минуту, ограничение только на секунду
+        return chat_id <= 0
+
+    def acquire(self, chat_id: int) -> float:
+        """
+        :return: 0, если слот занят и можно отправлять, иначе - через сколько секунд можно попробовать снова
+        """
+        with self.lock:
+            now = self.clock()
+            self._refill(now)
+            if now - self.swept >= self.SWEEP_INTERVAL:
+                self._sweep(now)
+            delays = [0.0 if self.tokens >= 1 else (1 - self.tokens) / self.per_second,
+                      self.paused - now, self.chat_paused.get(chat_id, 0.0) - now,
+                      self._window_delay(self.chat_seconds, chat_id, self.per_chat_second, self.CHAT_SECOND_WINDOW,
+                                         now)]
+            if self.is_group(chat_id):
+                delays.append(self._window_delay(self.chat_minutes, chat_id, self.per_chat_minute,
+                                                 self.CHAT_MINUTE_WINDOW, now))
+            delay = max(delays)
+            if delay > 0:
+                return delay
+            self.tokens -= 1
+            self.chat_seconds.setdefault(chat_id, deque()).append(now)
+            if self.is_group(chat_id):
+                self.chat_minutes.setdefault(chat_id, deque()).append(now)
+            return 0.0
+
+    def is_minute_limited(self, chat_id: int) -> bool:
+        with self.lock:
+            return self._window_delay(self.chat_minutes, chat_id, self.per_chat_minute, self.CHAT_MINUTE_WINDOW,
+                                      self.clock()) > 0
+
+    def report_retry_after(self, chat_id: int, retry_after: float):
+        """
+        Telegram ответил RetryAfter: чат ждёт retry_after секунд, а если так ответили сразу нескольким чатам -
+        ждут все
+        """
+        with self.lock:
+            now = self.clock()
+            self.chat_paused.update({chat_id: max(self.chat_paused.get(chat_id, 0.0), now + retry_after)})
+            self.retry_afters.append((now, chat_id))
+            while now - self.retry_afters[0][0] >= self.CHAT_SECOND_WINDOW:
+                self.retry_afters.popleft()
+            if len(set(map(lambda item: item[1], self.retry_afters))) >= self.GLOBAL_RETRY_AFTER_CHATS:
+                self.paused = max(self.paused, now + retry_after)
+
+    def _refill(self, now: float):
+        self.tokens = min(float(self.per_second), self.tokens + (now - self.refilled) * self.per_second)
+        self.refilled = now
+
+    @staticmethod
+    def _window_delay(windows: Dict[int, Deque[float]], chat_id: int, limit: int, window: float, now: float) -> float:
+        sent = windows.get(chat_id)
+        if not sent:
+            return 0.0
+        while sent and now - sent[0] >= window:
+            sent.popleft()
+        if len(sent) < limit:
+            return 0.0
+        return sent[0] + window - now
+
+    def _sweep(self, now: float):
+        for windows, window in ((self.chat_seconds, self.CHAT_SECOND_WINDOW),
+                                (self.chat_minutes, self.CHAT_MINUTE_WINDOW)):
+            for chat_id in [chat_id for chat_id, sent in windows.items() if not sent or now - sent[-1] >= window]:
+                windows.pop(chat_id)
+        for chat_id in [chat_id for chat_id, paused in self.chat_paused.items() if paused <= now]:
+            self.chat_paused.pop(chat_id)
+        self.swept = now
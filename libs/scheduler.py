@@ -0,0 +1,67 @@
+from typing import List, Tuple
+
+import heapq
+import random
+import itertools
+import threading
+import time
+
+# Повторы при сетевых ошибках (TimedOut / NetworkError, ошибки aiohttp): экспоненциальная задержка с jitter.
+# Общие для отправки потоками AsyncBot и через AsyncSendEngine
+NETWORK_RETRIES = 5
+NETWORK_BACKOFF_BASE = 0.5  # seconds
+NETWORK_BACKOFF_MAX = 30  # seconds
+
+
+def backoff(retry: int, base: float, maximum: float) -> float:
+    """
+    Задержка перед повтором номер retry (с 0): экспоненциальная base * 2^retry (не больше maximum)
+    со случайным множителем [0.5, 1], чтобы повторы разных сообщений не приходились на один момент
+    """
+    return min(maximum, base * 2 ** retry) * random.uniform(0.5, 1)
+
+
+class DelayedDelivery:
+    """
+    Отложенная постановка сообщений в очередь: куча (время, сообщение) и один поток.
+    Воркеры отправки не спят сами - сообщение, которому рано отправляться, возвращается в очередь по времени
+    """
+
+    def __init__(self):
+        self.heap: List[Tuple[float, int, object, object]] = []  # (когда, порядок, очередь, сообщение)
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.processing = True
+        self.thread = None
+
+    def schedule(self, delay: float, target_queue, message):
+        """
+        :param target_queue: Очередь с методом put, в которую сообщение попадёт через delay секунд
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (time.monotonic() + max(delay, 0), next(self.counter), target_queue, message))
+            self.condition.notify()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__work, name="delayed_delivery", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.processing = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.processing and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.processing:
+                    return
+                _, _, target_queue, message = heapq.heappop(self.heap)
+            target_queue.put(message)
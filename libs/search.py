@@ -0,0 +1,71 @@
+from collections import defaultdict, Counter
+from typing import Callable, Generic, Iterable, List, Set, Tuple, TypeVar
+
+import bisect
+
+T = TypeVar("T")
+
+
+def trigrams(name: str) -> Set[str]:
+    padded = "  {} ".format(name.lower())
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex(Generic[T]):
+    """
+    Поиск объектов по имени: точный префикс - бинарным поиском по отсортированным именам,
+    с опечатками - по доле общих триграмм (как pg_trgm similarity).
+    Результаты ранжируются: точное совпадение имени, затем rank_key (например, по уровню).
+    """
+    MIN_SIMILARITY = 0.3
+
+    def __init__(self, items: Iterable[Tuple[str, T]], rank_key: Callable[[T], object] = None):
+        items = list(filter(lambda item: item[0], items))
+        self.rank_key = rank_key or (lambda value: 0)
+        self.values: List[T] = list(map(lambda item: item[1], items))
+        self.names: List[str] = list(map(lambda item: item[0].lower(), items))
+        self.sorted_names: List[Tuple[str, int]] = sorted(map(lambda item: (item[1], item[0]), enumerate(self.names)))
+        self.trigram_index = defaultdict(list)
+        self.trigram_counts: List[int] = []
+        for i, name in enumerate(self.names):
+            name_trigrams = trigrams(name)
+            self.trigram_counts.append(len(name_trigrams))
+            for trigram in name_trigrams:
+                self.trigram_index[trigram].append(i)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _prefix(self, query: str) -> List[int]:
+        position = bisect.bisect_left(self.sorted_names, (query, ))
+        found = []
+        while position < len(self.sorted_names) and self.sorted_names[position][0].startswith(query):
+            found.append(self.sorted_names[position][1])
+            position += 1
+        return found
+
+    def _fuzzy(self, query: str) -> List[int]:
+        query_trigrams = trigrams(query)
+        common = Counter()
+        for trigram in query_trigrams:
+            common.update(self.trigram_index.get(trigram, ()))
+        similarities = map(lambda item: (item[0], item[1] / (len(query_trigrams) + self.trigram_counts[item[0]] -
+                                                             item[1])), common.items())
+        return list(map(lambda item: item[0], sorted(
+            filter(lambda item: item[1] >= self.MIN_SIMILARITY, similarities), key=lambda item: -item[1])))
+
+    def search(self, query: str, limit: int = None) -> List[T]:
+        """
+        Сначала совпадения по началу имени, если их нет - похожие имена (с опечатками)
+        """
+        query = query.lower()
+        found = self._prefix(query)
+        if found:
+            found.sort(key=lambda i: (self.names[i] != query, self.rank_key(self.values[i])))
+        else:
+            found = self._fuzzy(query)
+        return list(map(lambda i: self.values[i], found[:limit] if limit is not None else found))
+
+    def find(self, query: str) -> T:
+        found = self.search(query, limit=1)
+        return found[0] if found else None
@@ -0,0 +1,112 @@
+from sqlalchemy.orm import Session
+
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from bin.service import get_current_datetime
+
+from libs.models.Player import Player, PlayerFormatMixin
+from libs.models.Ship import Ship, ShipFormatMixin, suitable_ships_table, crashed_ships_table
+from libs.search import NameIndex
+
+import datetime
+
+
+class PlayerRecord(PlayerFormatMixin):
+    __slots__ = ("id", "username", "lvl", "exp", "rank", "faction", "location_id", "guild_id", "current_ship_id",
+                 "current_ship", "possible_ships")
+
+    def __init__(self, id, username, lvl, exp, rank, faction, location_id, guild_id, current_ship_id):
+        self.id, self.username, self.lvl, self.exp, self.rank, self.faction, self.location_id, self.guild_id, \
+            self.current_ship_id = id, username, lvl, exp, rank, faction, location_id, guild_id, current_ship_id
+        self.current_ship: Optional['ShipRecord'] = None
+        self.possible_ships: List['ShipRecord'] = []
+
+
+class ShipRecord(ShipFormatMixin):
+    __slots__ = ("id", "name", "code", "type", "status", "origin_id", "destination_id", "progress", "departed_date",
+                 "arrival_date", "is_crashed", "passengers_count", "possible_players", "crashed_players")
+
+    def __init__(self, id, name, code, type, status, origin_id, destination_id, progress, departed_date,
+                 arrival_date, is_crashed, passengers_count):
+        self.id, self.name, self.code, self.type, self.status, self.origin_id, self.destination_id, self.progress, \
+            self.departed_date, self.arrival_date, self.is_crashed, self.passengers_count = \
+            id, name, code, type, status, origin_id, destination_id, progress, departed_date, arrival_date, \
+            is_crashed, passengers_count
+        self.possible_players: List[PlayerRecord] = []
+        self.crashed_players: List[PlayerRecord] = []
+
+
+class WorldSnapshot:
+    """
+    Неизменяемое состояние мира на момент конца тика: игроки, корабли, пассажиры и разбившиеся.
+    Публикуется целиком (publish) и читается обработчиками команд без базы и без блокировок.
+    """
+    __slots__ = ("created", "players", "ships", "players_by_location", "players_by_faction", "ships_by_location",
+                 "player_index", "ship_index")
+
+    def __init__(self, players: List[PlayerRecord], ships: List[ShipRecord]):
+        self.created: datetime.datetime = get_current_datetime()
+        self.players: Dict[int, PlayerRecord] = {player.id: player for player in players}
+        self.ships: Dict[int, ShipRecord] = {ship.id: ship for ship in ships}
+        self.players_by_location: Dict[int, List[PlayerRecord]] = defaultdict(list)
+        self.players_by_faction: Dict[str, List[PlayerRecord]] = defaultdict(list)
+        for player in players:
+            self.players_by_location[player.location_id].append(player)
+            self.players_by_faction[(player.faction or "").lower()].append(player)
+        self.ships_by_location: Dict[int, List[ShipRecord]] = defaultdict(list)
+        for ship in ships:
+            self.ships_by_location[ship.origin_id].append(ship)
+            if ship.destination_id != ship.origin_id:
+                self.ships_by_location[ship.destination_id].append(ship)
+        # Игроки: точное имя первым, затем по уровню; корабли: точный код первым, затем по коду
+        self.player_index: NameIndex[PlayerRecord] = NameIndex(
+            map(lambda player: (player.username, player), players), rank_key=lambda player: -(player.lvl or 0))
+        self.ship_index: NameIndex[ShipRecord] = NameIndex(
+            map(lambda ship: (ship.code, ship), ships), rank_key=lambda ship: ship.code)
+
+    def find_player(self, name: str) -> Optional[PlayerRecord]:
+        return self.player_index.find(name)
+
+    def find_ship(self, code: str) -> Optional[ShipRecord]:
+        return self.ship_index.find(code)
+
+    @classmethod
+    def build(cls, session: Session) -> 'WorldSnapshot':
+        """
+        Собирает снапшот четырьмя запросами (игроки, корабли, пассажиры, разбившиеся)
+        """
+        players = list(map(lambda row: PlayerRecord(*row), session.query(
+            Player.id, Player.username, Player.lvl, Player.exp, Player.rank, Player.faction, Player.location_id,
+            Player.guild_id, Player.current_ship_id)))
+        ships = list(map(lambda row: ShipRecord(*row), session.query(
+            Ship.id, Ship.name, Ship.code, Ship.type, Ship.status, Ship.origin_id, Ship.destination_id, Ship.progress,
+            Ship.departed_date, Ship.arrival_date, Ship.is_crashed, Ship.passengers_count)))
+        players_by_id, ships_by_id = {player.id: player for player in players}, {ship.id: ship for ship in ships}
+        for player in players:
+            player.current_ship = ships_by_id.get(player.current_ship_id)
+        for player_id, ship_id in session.execute(suitable_ships_table.select()):
+            player, ship = players_by_id.get(player_id), ships_by_id.get(ship_id)
+            if player is not None and ship is not None:
+                player.possible_ships.append(ship)
+                ship.possible_players.append(player)
+        for player_id, ship_id in session.execute(crashed_ships_table.select()):
+            player, ship = players_by_id.get(player_id), ships_by_id.get(ship_id)
+            if player is not None and ship is not None:
+                ship.crashed_players.append(player)
+        return cls(players, ships)
+
+
+_snapshot: Optional[WorldSnapshot] = None
+
+
+def publish(snapshot: WorldSnapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def get_snapshot() -> Optional[WorldSnapshot]:
+    """
+    :return: Последний опубликованный снапшот или None (тогда обработчики идут в базу)
+    """
+    return _snapshot
@@ -13,9 +13,19 @@ from libs.updater import AsyncUpdater
 
 from config import TOKEN, request_kwargs, psql_credentials
 
+import config
+
+# Хранение истории изменений игроков: None - бессрочно, иначе число месяцев.
+# Старые партиции удаляются целиком или переносятся в history_archive_schema, если она задана
+history_retention_months = getattr(config, "history_retention_months", None)
+history_archive_schema = getattr(config, "history_archive_schema", None)
+# Отправка сообщений одним циклом asyncio (нужен aiohttp) вместо пула потоков
+async_send_engine = getattr(config, "async_send_engine", False)
+
 factions = {"fmc", "run", "gta"}
 
-bot = AsyncBot(token=TOKEN, workers=16, request_kwargs=request_kwargs)
+bot = AsyncBot(token=TOKEN, workers=4 if async_send_engine else 16, request_kwargs=request_kwargs,
+               async_engine=async_send_engine)
 updater = AsyncUpdater(bot=bot)
 
 dispatcher = updater.dispatcher
@@ -0,0 +1,126 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from libs.api import ExpeditionAPI, NotModified
+
+import json
+import threading
+import time
+
+import pytest
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Ответы заглушки API задаются функцией server.respond(handler) -> (status, headers, body)
+    """
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        status, headers, body = self.server.respond(self)
+        try:
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент не дождался ответа (таймаут)
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def json_response(data, headers=None):
+    return 200, dict({"Content-Type": "application/json"}, **(headers or {})), json.dumps(data).encode()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.respond = lambda handler: json_response({})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(ExpeditionAPI, "BASE_URL", "http://127.0.0.1:{}/".format(server.server_address[1]))
+    monkeypatch.setattr(ExpeditionAPI, "BACKOFF_FACTOR", 0)
+    # Сессия собирается заново с параметрами теста, валидаторы не переходят между тестами
+    monkeypatch.setattr(ExpeditionAPI, "_session", None)
+    monkeypatch.setattr(ExpeditionAPI, "_validators", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_conditional_request_not_modified(server):
+    def respond(handler):
+        if handler.headers.get("If-None-Match") == '"v1"':
+            return 304, {}, b""
+        return json_response({"ships": [{"id": 1}]},
+                             {"ETag": '"v1"', "Last-Modified": "Sat, 17 Oct 2026 12:00:00 GMT"})
+    server.respond = respond
+
+    assert ExpeditionAPI.get_ships() == {"ships": [{"id": 1}]}
+    with pytest.raises(NotModified):
+        ExpeditionAPI.get_ships()
+    headers = server.requests[1][1]
+    assert headers.get("If-None-Match") == '"v1"'
+    assert headers.get("If-Modified-Since") == "Sat, 17 Oct 2026 12:00:00 GMT"
+
+    ExpeditionAPI.reset_validators("ships")
+    assert ExpeditionAPI.get_ships() == {"ships": [{"id": 1}]}
+    assert "If-None-Match" not in server.requests[2][1]
+
+
+def test_server_error_is_retried(server):
+    def respond(handler):
+        if len(server.requests) <= 2:
+            return 503, {}, b"unavailable"
+        return json_response({"ships": []})
+    server.respond = respond
+
+    assert ExpeditionAPI.get_ships() == {"ships": []}
+    assert len(server.requests) == 3
+
+
+def test_server_error_after_retries(server):
+    server.respond = lambda handler: (502, {}, b"bad gateway")
+
+    with pytest.raises(RuntimeError):
+        ExpeditionAPI.get_ships()
+    assert len(server.requests) == ExpeditionAPI.RETRIES + 1
+
+
+def test_timeout(server, monkeypatch):
+    monkeypatch.setattr(ExpeditionAPI, "TIMEOUT", (1, 0.2))
+    monkeypatch.setattr(ExpeditionAPI, "RETRIES", 0)
+
+    def respond(handler):
+        time.sleep(1)
+        return json_response({"ships": []})
+    server.respond = respond
+
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        ExpeditionAPI.get_ships()
+    assert time.monotonic() - started < 1
+
+
+def test_fetch_all_is_concurrent(server):
+    # Каждый запрос ждёт второй: последовательная загрузка не дождётся барьера
+    barrier = threading.Barrier(2, timeout=5)
+
+    def respond(handler):
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            return 500, {}, b"not concurrent"
+        endpoint = handler.path.strip("/")
+        return json_response({endpoint: [{"id": 1}, {"id": 2}]})
+    server.respond = respond
+
+    futures = ExpeditionAPI.fetch_all("users", "ships", streams=("users", ))
+    assert list(futures.get("users").result()) == [{"id": 1}, {"id": 2}]
+    assert futures.get("ships").result() == {"ships": [{"id": 1}, {"id": 2}]}
+    assert sorted(map(lambda request: request[0], server.requests)) == ["/ships", "/users"]
@@ -0,0 +1,23 @@
+from libs.eta import ProgressSamples
+
+import datetime
+
+START = datetime.datetime(2026, 10, 18, 12, 0)
+
+
+def test_estimate_linear_progress():
+    samples = ProgressSamples()
+    for minute in range(5):
+        samples.add(1, START + datetime.timedelta(minutes=minute), 10.0 * minute)
+    arrival = samples.estimate(START + datetime.timedelta(minutes=4)).get(1)
+    assert abs((arrival - (START + datetime.timedelta(minutes=10))).total_seconds()) < 1
+
+
+def test_prune_keeps_only_underway_ships():
+    samples = ProgressSamples()
+    for ship_id in (1, 2, 3):
+        samples.add(ship_id, START, 50.0)
+    samples.prune([2, 4])
+    assert set(samples.samples) == {2}
+    assert set(samples.counts) == {2}
+    assert set(samples.last_progress) == {2}
@@ -0,0 +1,103 @@
+import pytest
+
+# Нужна база PostgreSQL из config.py: данные теста пишутся в транзакции, которая откатывается
+pytest.importorskip("config")
+
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+from resources.globals import engine
+
+from libs.models.Guild import Guild
+from libs.models.Location import Location, SPACE_NAME
+from libs.models.Player import Player
+from libs.models.Ship import Ship
+
+from bin.service import get_current_datetime
+
+import bin.api
+import bin.service
+
+
+class RecordingBot:
+    def __init__(self):
+        self.calls = []
+
+    def editMessageTextRestricted(self, **kwargs):
+        self.calls.append(("editMessageTextRestricted", kwargs))
+
+    def send_message(self, **kwargs):
+        self.calls.append(("send_message", kwargs))
+
+
+@pytest.fixture
+def session(monkeypatch):
+    connection = engine.connect()
+    transaction = connection.begin()
+    session_maker = sessionmaker(bind=connection, autoflush=False)
+    monkeypatch.setattr(bin.service, "SessionMaker", session_maker)
+    monkeypatch.setattr(bin.api, "guild_stats_hashes", {})
+    monkeypatch.setattr(Location, "REGISTRY", Location.REGISTRY)
+    monkeypatch.setattr(Location, "SPACE_ID", Location.SPACE_ID)
+    session = session_maker()
+    yield session
+    session.close()
+    transaction.rollback()
+    connection.close()
+
+
+def create_guild(session, players_count: int) -> Guild:
+    """
+    Гильдия из players_count игроков: половина на планете, половина в полёте на кораблях по 5 пассажиров
+    """
+    if session.query(Location).filter_by(name=SPACE_NAME).first() is None:
+        session.add(Location(name=SPACE_NAME))
+    planet = Location(name="Test planet {}".format(players_count))
+    guild = Guild(name="Test guild {}".format(players_count), chat_id=-1, stats_message_id=1)
+    session.add_all([planet, guild])
+    session.flush()
+    Location.init_database(session)
+
+    ships = list(map(lambda i: Ship(ship_id="test_{}_{}".format(players_count, i), code="T{}".format(i),
+                                    origin_id=planet.id, destination_id=planet.id, progress=50,
+                                    departed_date=get_current_datetime()), range(players_count // 10 + 1)))
+    session.add_all(ships)
+    session.flush()
+    for i in range(players_count):
+        in_space = i % 2 == 1
+        session.add(Player(game_id="test_{}_{}".format(players_count, i), username="player{}".format(i), lvl=i,
+                           exp=i, rank=i, faction="fmc", guild_id=guild.id,
+                           location_id=Location.SPACE_ID if in_space else planet.id,
+                           current_ship_id=ships[i // 10].id if in_space else None))
+    session.flush()
+    return guild
+
+
+def count_queries(connection, function, *args) -> int:
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(connection, "before_cursor_execute", before_cursor_execute)
+    try:
+        function(*args)
+    finally:
+        event.remove(connection, "before_cursor_execute", before_cursor_execute)
+    return len(queries)
+
+
+PLAYERS_COUNT = 10
+
+
+def test_guild_stats_query_count_does_not_grow(session):
+    small_guild = create_guild(session, PLAYERS_COUNT)
+    large_guild = create_guild(session, PLAYERS_COUNT * 10)
+
+    bot = RecordingBot()
+    small_queries = count_queries(session.bind, bin.api.update_guild_stats, bot, small_guild.id)
+    large_queries = count_queries(session.bind, bin.api.update_guild_stats, bot, large_guild.id)
+
+    assert small_queries == large_queries
+    assert list(map(lambda call: call[0], bot.calls)) == ["editMessageTextRestricted"] * 2
+    assert bot.calls[1][1].get("text").count("player") == PLAYERS_COUNT * 10
@@ -0,0 +1,27 @@
+from libs.json_stream import iter_array_items
+
+import json
+
+import pytest
+
+PAYLOAD = json.dumps({"ok": True, "users": [1, -1500.0, 2.5e-3, "a, b]", True, False, None, {"userId": "u1"},
+                                            [1, [2]], 123456789]}, ensure_ascii=False)
+
+
+def test_number_split_across_chunks():
+    assert list(iter_array_items(['{"users": [1, -1500.', '0, 2]}'], "users")) == [1, -1500.0, 2]
+
+
+@pytest.mark.parametrize("split", range(1, len(PAYLOAD)))
+def test_any_chunk_boundary(split):
+    chunks = [PAYLOAD[:split], PAYLOAD[split:]]
+    assert list(iter_array_items(chunks, "users")) == json.loads(PAYLOAD).get("users")
+
+
+def test_one_character_chunks():
+    assert list(iter_array_items(iter(PAYLOAD), "users")) == json.loads(PAYLOAD).get("users")
+
+
+def test_truncated_payload():
+    with pytest.raises(ValueError):
+        list(iter_array_items(['{"users": [1, 2'], "users"))
@@ -0,0 +1,12 @@
+from libs.partitions import is_partition_name, partition_name, default_partition_name, HISTORY_TABLES
+
+import datetime
+
+
+def test_partition_names_are_recognized():
+    for table in HISTORY_TABLES:
+        assert is_partition_name(partition_name(table, datetime.date(2026, 10, 1)))
+        assert is_partition_name(default_partition_name(table))
+        assert not is_partition_name(table)
+    assert not is_partition_name("players")
+    assert not is_partition_name("exp_changes_y2026m1")